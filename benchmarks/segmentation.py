@@ -0,0 +1,74 @@
+"""
+Time trajutils.segment_traj_by_dist_time_speed against the per-id loop it replaced,
+on n_rows points of about 100 points per id, sorted by id, and check both give the same segments.
+With pymove installed (pip install -e .):
+    python benchmarks/segmentation.py 2000000
+    python benchmarks/segmentation.py 10000000 --skip-loop
+"""
+import argparse
+import logging
+import time
+import numpy as np
+import pandas as pd
+from pymove import trajutils
+from pymove import utils as ut
+
+
+def segment_by_loop(df_, label_id, max_dist, max_time, max_speed, label_segment='tid_part'):
+    """ the per-id loop of segment_traj_by_dist_time_speed before _segment_traj_by_thresholds, without its messages """
+    df_.set_index(label_id, inplace=True)
+    curr_tid = 0
+    df_[label_segment] = curr_tid
+    for idx in df_.index.unique():
+        curr_tid += 1
+        filter_ = (df_.at[idx, 'time_to_prev'] > max_time) | (df_.at[idx, 'dist_to_prev'] > max_dist) | \
+                  (df_.at[idx, 'speed_to_prev'] > max_speed)
+        if filter_.shape == ():
+            df_.at[idx, label_segment] = curr_tid
+        else:
+            tids = np.empty(filter_.shape[0], dtype=np.int64)
+            tids.fill(curr_tid)
+            for i, has_problem in enumerate(filter_):
+                if has_problem:
+                    curr_tid += 1
+                    tids[i:] = curr_tid
+            df_.at[idx, label_segment] = tids
+    df_.reset_index(inplace=True)
+
+
+def make_frame(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'id': np.sort(rng.integers(0, max(n_rows // 100, 1), n_rows)),
+                         'dist_to_prev': rng.exponential(500, n_rows),
+                         'time_to_prev': rng.exponential(60, n_rows),
+                         'speed_to_prev': rng.exponential(10, n_rows)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('n_rows', type=int, nargs='?', default=2000000)
+    parser.add_argument('--skip-loop', action='store_true', help='time only the current implementation')
+    args = parser.parse_args()
+
+    ut.set_verbosity('quiet')
+    thresholds = {'max_dist': 2000, 'max_time': 300, 'max_speed': 40}
+    df = make_frame(args.n_rows)
+
+    df_new = df.copy()
+    start_time = time.perf_counter()
+    trajutils.segment_traj_by_dist_time_speed(df_new, max_dist_between_adj_points=thresholds['max_dist'],
+                                              max_time_between_adj_points=thresholds['max_time'],
+                                              max_speed_between_adj_points=thresholds['max_speed'])
+    print('{} rows, {} ids: segment_traj_by_dist_time_speed {:.2f}s'.format(df.shape[0], df['id'].nunique(), time.perf_counter() - start_time))
+
+    if not args.skip_loop:
+        df_loop = df.copy()
+        start_time = time.perf_counter()
+        segment_by_loop(df_loop, 'id', **thresholds)
+        print('{} rows: per-id loop {:.2f}s'.format(df.shape[0], time.perf_counter() - start_time))
+        pd.testing.assert_frame_equal(df_new, df_loop)
+    ut.set_verbosity(logging.INFO)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pymove import trajutils
+from pymove import utils as ut
+
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pass
+
+
+def _is_parquet(filename):
+    return os.path.splitext(filename)[1].lower() in ['.parquet', '.pq']
+
+def read_chunks(filename, chunksize=1000000, dic_labels=trajutils.dic_labels, **kwargs):
+    """
+    Read a CSV or Parquet file in chunks of at most chunksize rows.
+    kwargs are passed to pd.read_csv, by default the datetime label is parsed as datetime.
+        Example:
+            for chunk in read_chunks('taxi.csv', chunksize=500000, sep=';'):
+                ...
+    """
+    if _is_parquet(filename):
+        parquet_file = pq.ParquetFile(filename)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=kwargs.get('columns')):
+            yield batch.to_pandas()
+    else:
+        kwargs.setdefault('parse_dates', [dic_labels['datetime']])
+        for chunk in pd.read_csv(filename, chunksize=chunksize, **kwargs):
+            yield chunk
+
+def _is_arrow(filename):
+    return os.path.splitext(filename)[1].lower() in ['.arrow', '.feather', '.ipc']
+
+def _source_labels(labels, dic_labels):
+    """ source column of the id, lat, lon and datetime labels, given labels {source column: pymove label} """
+    sources = {label: source for source, label in labels.items()}
+    return {key: sources.get(dic_labels[key], dic_labels[key]) for key in ['id', 'lat', 'lon', 'datetime']}
+
+def _datetime_bound(value, tz):
+    """ start or end datetime comparable to datetimes in tz: naive bounds are taken in tz, aware ones converted to it """
+    value = pd.Timestamp(value)
+    if tz is None:
+        if value.tzinfo is not None:
+            raise ValueError('the datetimes have no timezone, start_datetime and end_datetime must be naive, not {}'.format(value))
+        return value
+    return value.tz_localize(tz) if value.tzinfo is None else value.tz_convert(tz)
+
+def _arrow_filter(dataset, sources, bbox, start_datetime, end_datetime):
+    """ pyarrow.dataset expression of the bbox and datetime filters, pruning row groups by their statistics """
+    filter_ = None
+    conditions = []
+    if bbox is not None:
+        conditions += [ds.field(sources['lat']) >= bbox[0], ds.field(sources['lat']) <= bbox[2],
+                       ds.field(sources['lon']) >= bbox[1], ds.field(sources['lon']) <= bbox[3]]
+    datetime_type = dataset.schema.field(sources['datetime']).type
+    if pa.types.is_timestamp(datetime_type):
+        if start_datetime is not None:
+            conditions.append(ds.field(sources['datetime']) >= pa.scalar(_datetime_bound(start_datetime, datetime_type.tz), type=datetime_type))
+        if end_datetime is not None:
+            conditions.append(ds.field(sources['datetime']) <= pa.scalar(_datetime_bound(end_datetime, datetime_type.tz), type=datetime_type))
+    for condition in conditions:
+        filter_ = condition if filter_ is None else filter_ & condition
+    return filter_
+
+def _format_trajectory_chunk(chunk, labels, dic_labels, bbox, start_datetime, end_datetime, lat_dtype, datetime_format):
+    """ rename to pymove labels, parse the datetime, filter by bbox and datetime and downcast lat and lon """
+    chunk = chunk.rename(columns=labels)
+    datetime = chunk[dic_labels['datetime']]
+    if not pd.api.types.is_datetime64_any_dtype(datetime):
+        datetime = pd.to_datetime(datetime, format=datetime_format)
+    chunk[dic_labels['datetime']] = datetime.astype('datetime64[ns]') if getattr(datetime.dt, 'tz', None) is None else datetime
+
+    filter_ = np.ones(chunk.shape[0], dtype=np.bool_)
+    if bbox is not None:
+        lat = chunk[dic_labels['lat']].values
+        lon = chunk[dic_labels['lon']].values
+        filter_ &= (lat >= bbox[0]) & (lat <= bbox[2]) & (lon >= bbox[1]) & (lon <= bbox[3])
+    tz = getattr(datetime.dt, 'tz', None)
+    if start_datetime is not None:
+        filter_ &= (chunk[dic_labels['datetime']] >= _datetime_bound(start_datetime, tz)).values
+    if end_datetime is not None:
+        filter_ &= (chunk[dic_labels['datetime']] <= _datetime_bound(end_datetime, tz)).values
+    if not filter_.all():
+        chunk = chunk.loc[filter_]
+
+    chunk[dic_labels['lat']] = chunk[dic_labels['lat']].astype(lat_dtype)
+    chunk[dic_labels['lon']] = chunk[dic_labels['lon']].astype(lat_dtype)
+    return chunk
+
+def read_trajectories(filename, labels=None, columns=None, bbox=None, start_datetime=None, end_datetime=None, lat_dtype=np.float32, 
+                      id_dtype='auto', datetime_format=None, chunksize=1000000, dic_labels=trajutils.dic_labels, **kwargs):
+    """
+    Load trajectories from a CSV, Parquet or Arrow (.arrow, .feather, .ipc) file, with the columns renamed by 
+    labels {source column: pymove label}, e.g. {'vehicle': 'id', 'latitude': 'lat', 'longitude': 'lon', 'time': 'datetime'}.
+    Only the id, lat, lon and datetime columns plus the source columns in columns are read (all of them if columns is None).
+    Rows out of bbox (lat_down, lon_left, lat_up, lon_right) or out of [start_datetime, end_datetime] are dropped
+    while reading (with timezone aware datetimes, naive bounds are in their timezone): in Parquet and Arrow files the filters are pushed down to the scan, which skips row groups 
+    out of range, and CSV files are read and filtered chunksize rows at a time, so the whole file is never in memory.
+    lat and lon are converted to lat_dtype (float32 keeps about 1 meter), the datetime to datetime64[ns] 
+    (with datetime_format when given, which is much faster for CSV), and with id_dtype='auto' string ids become 
+    a category and integer ids the smallest integer dtype; id_dtype None keeps them.
+    kwargs are passed to pd.read_csv.
+        Example:
+            df = read_trajectories('taxi.parquet', {'taxi_id': 'id'}, bbox=[-3.90, -38.67, -3.68, -38.38])
+    """
+    try:
+        ut.log('\nReading trajectories from {}...\n'.format(filename))
+        start_time = time.time()
+        if labels is None:
+            labels = {}
+        sources = _source_labels(labels, dic_labels)
+        projection = None if columns is None else list(sources.values()) + [column for column in columns if column not in sources.values()]
+
+        chunks = []
+        if _is_parquet(filename) or _is_arrow(filename):
+            dataset = ds.dataset(filename, format='parquet' if _is_parquet(filename) else 'ipc')
+            filter_ = _arrow_filter(dataset, sources, bbox, start_datetime, end_datetime)
+            for batch in dataset.to_batches(columns=projection, filter=filter_, batch_size=chunksize):
+                chunks.append(_format_trajectory_chunk(batch.to_pandas(), labels, dic_labels, bbox, start_datetime, end_datetime, lat_dtype, datetime_format))
+        else:
+            kwargs.setdefault('dtype', {sources['lat']: np.float64, sources['lon']: np.float64})
+            for chunk in pd.read_csv(filename, chunksize=chunksize, usecols=projection, **kwargs):
+                chunks.append(_format_trajectory_chunk(chunk, labels, dic_labels, bbox, start_datetime, end_datetime, lat_dtype, datetime_format))
+            
+        label_id = dic_labels['id']
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=[labels.get(column, column) for column in projection or sources.values()])
+        if id_dtype == 'auto':
+            if all(pd.api.types.is_integer_dtype(chunk[label_id]) for chunk in chunks):
+                id_dtype = 'integer'
+            else:
+                id_dtype = 'category'
+        if id_dtype == 'category':
+            ids = union_categoricals([pd.Categorical(chunk.pop(label_id)) for chunk in chunks], sort_categories=True)
+        df_ = pd.concat(chunks, ignore_index=True)
+        if id_dtype == 'category':
+            df_[label_id] = ids
+        elif id_dtype == 'integer':
+            df_[label_id] = pd.to_numeric(df_[label_id], downcast='integer')
+        elif id_dtype is not None:
+            df_[label_id] = df_[label_id].astype(id_dtype)
+        df_.insert(0, label_id, df_.pop(label_id))
+
+        ut.log('...{} rows, {:.2f} MB'.format(df_.shape[0], df_.memory_usage(deep=True).sum() / 1024**2))
+        ut.log('..Total Time: {:.2f}'.format((time.time() - start_time)))
+        return df_
+    except Exception as e:
+        raise e
+
+def _iter_grouped_by_id(chunks, label_id):
+    """
+    Input grouped by id: the rows of the last id of each chunk are held back and
+    concatenated to the next chunk, as they may continue there.
+    """
+    carry = None
+    seen = set()
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.shape[0] == 0:
+            continue
+
+        ids = chunk[label_id].values
+        other_ids = np.flatnonzero(ids != ids[-1])
+        split = other_ids[-1] + 1 if other_ids.shape[0] > 0 else 0
+        carry = chunk.iloc[split:].copy()
+        chunk = chunk.iloc[:split].copy()
+
+        ids_chunk = chunk[label_id].unique()
+        if (len(seen.intersection(ids_chunk)) > 0) or (ids[-1] in set(ids_chunk)):
+            raise ValueError('{} is not grouped by id, use sorted_by_id=False'.format(label_id))
+        seen.update(ids_chunk)
+        if chunk.shape[0] > 0:
+            yield chunk
+
+    if carry is not None and carry.shape[0] > 0:
+        if carry[label_id].iloc[0] in seen:
+            raise ValueError('{} is not grouped by id, use sorted_by_id=False'.format(label_id))
+        yield carry
+
+def _iter_partitioned_by_id(chunks, label_id, n_partitions, tmp_dir):
+    """
+    Input in any order: the rows are hash partitioned by id into n_partitions temporary files,
+    then each partition is read back as a whole.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='pymove_', dir=tmp_dir)
+    try:
+        files = [os.path.join(tmp_dir, 'partition_{}.pkl'.format(i)) for i in range(n_partitions)]
+        for chunk in chunks:
+            partition = pd.util.hash_pandas_object(chunk[label_id], index=False).values % n_partitions
+            for i, df_partition in chunk.groupby(partition):
+                with open(files[i], 'ab') as f:
+                    pickle.dump(df_partition, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        for filename in files:
+            if not os.path.exists(filename):
+                continue
+            parts = []
+            with open(filename, 'rb') as f:
+                while True:
+                    try:
+                        parts.append(pickle.load(f))
+                    except EOFError:
+                        break
+            os.remove(filename)
+            yield pd.concat(parts, ignore_index=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def read_by_id(filename, label_id=trajutils.dic_labels['id'], chunksize=1000000, sorted_by_id=True, n_partitions=64, tmp_dir=None, **kwargs):
+    """
+    Read a CSV or Parquet file in partitions where all points of an id are in the same partition.
+    If the file is grouped by id (sorted_by_id=True) each partition has about chunksize rows,
+    plus the rows of an id that straddles the chunk boundary.
+    Otherwise, the points are first spilled into n_partitions temporary files in tmp_dir,
+    then each partition has about (rows in file / n_partitions) rows.
+    """
+    chunks = read_chunks(filename, chunksize, **kwargs)
+    if sorted_by_id:
+        return _iter_grouped_by_id(chunks, label_id)
+    else:
+        return _iter_partitioned_by_id(chunks, label_id, n_partitions, tmp_dir)
+
+def _parquet_schema(schema):
+    """ schema of the Parquet writer, with int32 category indexes, as later partitions may have more categories """
+    fields = [field.with_type(pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered)) if pa.types.is_dictionary(field.type) else field
+              for field in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+def _write_chunk(df_, filename, writer, first_chunk):
+    """ append a chunk to a CSV or Parquet file, returns the parquet writer to the next chunk """
+    if _is_parquet(filename):
+        table = pa.Table.from_pandas(df_, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(filename, _parquet_schema(table.schema))
+        if not table.schema.equals(writer.schema, check_metadata=False):
+            """ the dtypes of a partition may differ from the first one, e.g. a column with NaN only in some """
+            table = table.select(writer.schema.names).cast(writer.schema)
+        writer.write_table(table)
+    else:
+        df_.to_csv(filename, mode='w' if first_chunk else 'a', header=first_chunk, index=False)
+    return writer
+
+def process_by_chunks(input_file, output_file, steps, label_id=trajutils.dic_labels['id'], chunksize=1000000, sorted_by_id=True,
+                      n_partitions=64, offset_labels=None, tmp_dir=None, **kwargs):
+    """
+    Run trajutils steps on a CSV or Parquet file larger than memory, partition by partition,
+    writing the results incrementally to output_file (CSV or Parquet, from the extension).
+    steps is a list of functions or (function, kwargs) tuples that change the dataframe inplace.
+    Integer columns created per partition, like the label_segment of segment_traj_by_*, must be in
+    offset_labels so they keep unique across partitions.
+    In a Parquet output_file, each partition is cast to the column types of the first one.
+        Example:
+            process_by_chunks('taxi.csv', 'taxi_clean.parquet',
+                [trajutils.create_update_dist_time_speed_features,
+                 (trajutils.clean_gps_speed_max_radius, {'speed_max': 50}),
+                 (trajutils.segment_traj_by_max_time, {'max_time_between_adj_points': 900})],
+                chunksize=2000000, offset_labels=['tid_time'])
+    Returns the number of rows read and written.
+    """
+    try:
+        ut.log('\nProcessing {} by chunks of {} rows...\n'.format(input_file, chunksize))
+        start_time = time.time()
+        if offset_labels is None:
+            offset_labels = []
+        rows_in = 0
+        rows_out = 0
+        offsets = {label: 0 for label in offset_labels}
+        writer = None
+
+        for i, df_ in enumerate(read_by_id(input_file, label_id, chunksize, sorted_by_id, n_partitions, tmp_dir, **kwargs)):
+            rows_in += df_.shape[0]
+            for step in steps:
+                if callable(step):
+                    step(df_)
+                else:
+                    step[0](df_, **step[1])
+
+            for label in offset_labels:
+                if label in df_ and df_.shape[0] > 0:
+                    df_[label] += offsets[label]
+                    offsets[label] = df_[label].max()
+
+            writer = _write_chunk(df_, output_file, writer, i == 0)
+            rows_out += df_.shape[0]
+            ut.log('...partition {}: rows read: {}, rows written: {}\n'.format(i, rows_in, rows_out))
+
+        if writer is not None:
+            writer.close()
+        ut.log('...Rows read: {}, Rows written: {}'.format(rows_in, rows_out))
+        ut.log('\nTotal Time: {:.2f} seconds'.format((time.time() - start_time)))
+        ut.log('-----------------------------------------------------\n')
+        return rows_in, rows_out
+    except Exception as e:
+        raise e
@@ -1,12 +1,24 @@
-from tqdm import tqdm_notebook as tqdm
+import logging
 import pandas as pd
 import numpy as np
 from sklearn.cluster import KMeans
 import matplotlib.pyplot as plt
+from pymove import utils as ut
+
+try:
+    from tqdm.auto import tqdm as _tqdm
+except ImportError:
+    _tqdm = None
+
+def tqdm(iterable):
+    """ progress bar of tqdm (a widget in notebooks, text otherwise), hidden when the pymove verbosity is above INFO """
+    if _tqdm is None or not ut.logger.isEnabledFor(logging.INFO):
+        return iterable
+    return _tqdm(iterable)
 
 def elbow_method(df_, k_initial=1, maxClusters=15, k_iteration=1):
     # to validing K value in K-means
-    print('Executing Elbow Method to:\n...K of {} to {} from k_iteration:{}\n'.format(k_initial,maxClusters, k_iteration))
+    ut.log('Executing Elbow Method to:\n...K of {} to {} from k_iteration:{}\n'.format(k_initial,maxClusters, k_iteration))
     inertia_dic = {}
     for k in tqdm(range(k_initial, maxClusters, k_iteration)):
         ## validing K value in K-means
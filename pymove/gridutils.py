@@ -1,15 +1,25 @@
+import json
 import math
+import time
 import numpy as np
+import pandas as pd
 import matplotlib as plt
 import matplotlib.pyplot as plt
 
-from tqdm import tqdm_notebook as tqdm
+from functools import lru_cache
 from geojson import Feature, FeatureCollection
 from shapely.geometry import Polygon
 from geojson import Polygon as jsonPolygon
 import pickle
 
+try:
+    # shapely >= 2.0 creates arrays of geometries in bulk
+    from shapely import polygons as shapely_polygons
+except ImportError:
+    shapely_polygons = None
+
 from pymove import trajutils
+from pymove import utils as ut
 
 def lat_meters(Lat):
     """
@@ -26,11 +36,11 @@ def lat_meters(Lat):
     return meters
 
 def create_virtual_grid(cell_size, bbox, meters_by_degree = lat_meters(-3.8162973555)):
-    print('\nCreating a virtual grid without polygons')
+    ut.log('\nCreating a virtual grid without polygons')
     
     # Latitude in Fortaleza: -3.8162973555
     cell_size_by_degree = cell_size/meters_by_degree
-    print('...cell size by degree: {}'.format(cell_size_by_degree))
+    ut.log('...cell size by degree: {}'.format(cell_size_by_degree))
 
     lat_min_y = bbox[0]
     lon_min_x = bbox[1]
@@ -49,7 +59,7 @@ def create_virtual_grid(cell_size, bbox, meters_by_degree = lat_meters(-3.816297
     grid_size_lat_y = int(round((lat_max_y - lat_min_y) / cell_size_by_degree))
     grid_size_lon_x = int(round((lon_max_x - lon_min_x) / cell_size_by_degree))
     
-    print('...grid_size_lat_y:{}\ngrid_size_lon_x:{}'.format(grid_size_lat_y, grid_size_lon_x))
+    ut.log('...grid_size_lat_y:{}\ngrid_size_lon_x:{}'.format(grid_size_lat_y, grid_size_lon_x))
 
     # Return a dicionary virtual grid 
     my_dict = dict()
@@ -59,77 +69,533 @@ def create_virtual_grid(cell_size, bbox, meters_by_degree = lat_meters(-3.816297
     my_dict['grid_size_lat_y'] = grid_size_lat_y
     my_dict['grid_size_lon_x'] = grid_size_lon_x
     my_dict['cell_size_by_degree'] = cell_size_by_degree
-    print('\n..A virtual grid was created')
+    ut.log('\n..A virtual grid was created')
     return my_dict
 
-def create_all_polygons_on_grid(dic_grid):
-    # Cria o vetor vazio de gometrias da grid
+def _polygons_coords(dic_grid, index_grid_lat, index_grid_lon):
+    """ (n, 4, 2) array with the (lat, lon) corners of each cell, in the order used by the cell polygons """
+    lat_init = dic_grid['lat_min_y'] + dic_grid['cell_size_by_degree'] * np.asarray(index_grid_lat, dtype=np.float64)
+    lon_init = dic_grid['lon_min_x'] + dic_grid['cell_size_by_degree'] * np.asarray(index_grid_lon, dtype=np.float64)
+    lat_end = lat_init + dic_grid['cell_size_by_degree']
+    lon_end = lon_init + dic_grid['cell_size_by_degree']
+    return np.stack([np.stack([lat_init, lon_init], axis=-1),
+                     np.stack([lat_end, lon_init], axis=-1),
+                     np.stack([lat_end, lon_end], axis=-1),
+                     np.stack([lat_init, lon_end], axis=-1)], axis=-2)
+
+def create_polygons_on_grid(dic_grid, index_grid_lat, index_grid_lon):
+    """
+    Object array with the polygon of each cell (index_grid_lat[i], index_grid_lon[i]).
+    The corners are computed in bulk and shapely >= 2 creates all polygons in one call.
+    """
+    coords = _polygons_coords(dic_grid, index_grid_lat, index_grid_lon)
+    if shapely_polygons is not None:
+        return shapely_polygons(coords)
+    polygons = np.empty(coords.shape[0], dtype=object)
+    for i in range(coords.shape[0]):
+        polygons[i] = Polygon(coords[i])
+    return polygons
+
+def create_all_polygons_on_grid(dic_grid, all_cells=False):
+    """
+    Set dic_grid['grid_polygon'], the polygons of the cells as grid_polygon[index_grid_lat][index_grid_lon]
+    (or [index_grid_lat, index_grid_lon]). By default each polygon is created when accessed, from the LRU cache
+    of create_one_polygon_to_point_on_grid, so no cell is built in advance. all_cells=True builds the object array
+    of the polygons of every cell, grid_size_lat_y * grid_size_lon_x polygons: use it only for small grids.
+    To create only the polygons of the cells with points use create_all_polygons_to_all_point_on_grid.
+    """
     try:
-        print('\nCreating all polygons on virtual grid')
-        grid_polygon = np.array([[None for i in range(dic_grid['grid_size_lon_x'])] for j in range(dic_grid['grid_size_lat_y'])])
-        lat_init = dic_grid['lat_min_y']    
-        for i in tqdm(range(dic_grid['grid_size_lat_y'])):
-            lon_init = dic_grid['lon_min_x']
-            for j in range(dic_grid['grid_size_lon_x']):
-                # Cria o polygon da célula
-                grid_polygon[i][j] = Polygon(((lat_init, lon_init),
-                                            (lat_init + dic_grid['cell_size_by_degree'], lon_init),
-                                            (lat_init + dic_grid['cell_size_by_degree'], lon_init + dic_grid['cell_size_by_degree']),
-                                            (lat_init, lon_init + dic_grid['cell_size_by_degree'])
-                                            ))
-                lon_init += dic_grid['cell_size_by_degree']
-            lat_init += dic_grid['cell_size_by_degree']
-        dic_grid['grid_polygon'] = grid_polygon
-        print('...geometry was created to a virtual grid')
+        if not all_cells:
+            dic_grid['grid_polygon'] = LazyGridPolygons(dic_grid)
+            ut.log('\n...polygons of the virtual grid are created on access')
+            return
+        ut.log('\nCreating all polygons on virtual grid')
+        index_grid_lat, index_grid_lon = np.meshgrid(np.arange(dic_grid['grid_size_lat_y']), np.arange(dic_grid['grid_size_lon_x']), indexing='ij')
+        grid_polygon = create_polygons_on_grid(dic_grid, index_grid_lat.ravel(), index_grid_lon.ravel())
+        dic_grid['grid_polygon'] = grid_polygon.reshape(index_grid_lat.shape)
+        ut.log('...geometry was created to a virtual grid')
     except Exception as e:
         raise e
 
 def create_all_polygons_to_all_point_on_grid(df_, dic_grid):
+    """ polygons of the cells with points only, one row by distinct (index_grid_lat, index_grid_lon) """
     try:
         df_polygons = df_.loc[:,['index_grid_lat', 'index_grid_lon']].drop_duplicates()
-
-        size = df_polygons.shape[0]
-        
-        """transform series in numpyarray"""
-        index_grid_lat = np.array(df_['index_grid_lat'])
-        index_grid_lon = np.array(df_['index_grid_lon'])
-
-        """transform series in numpyarray"""
-        polygons = np.array([])
-
-        for i in tqdm(range(size)):
-            p = create_one_polygon_to_point_on_grid(dic_grid, index_grid_lat[i], index_grid_lon[i])
-            polygons = np.append(polygons, p)
-        print('...polygons were created')
-        df_polygons['polygon'] = polygons
+        df_polygons['polygon'] = create_polygons_on_grid(dic_grid, df_polygons['index_grid_lat'].values, df_polygons['index_grid_lon'].values)
+        ut.log('...{} polygons were created'.format(df_polygons.shape[0]))
         return df_polygons
     except Exception as e:
-        print('size:{}, i:{}'.format(size, i))
+        ut.log('size:{}'.format(df_polygons.shape[0]))
         raise e  
 
+@lru_cache(maxsize=65536)
+def _cached_polygon(lat_min_y, lon_min_x, cell_size_by_degree, index_grid_lat, index_grid_lon):
+    dic_grid = {'lat_min_y': lat_min_y, 'lon_min_x': lon_min_x, 'cell_size_by_degree': cell_size_by_degree}
+    return Polygon(_polygons_coords(dic_grid, index_grid_lat, index_grid_lon))
+
 def create_one_polygon_to_point_on_grid(dic_grid, index_grid_lat, index_grid_lon):
-    lat_init = dic_grid['lat_min_y'] + dic_grid['cell_size_by_degree'] * index_grid_lat
-    lon_init = dic_grid['lon_min_x'] + dic_grid['cell_size_by_degree'] * index_grid_lon
-    polygon = Polygon(((lat_init, lon_init),
-         (lat_init + dic_grid['cell_size_by_degree'], lon_init),
-         (lat_init + dic_grid['cell_size_by_degree'], lon_init + dic_grid['cell_size_by_degree']),
-         (lat_init, lon_init + dic_grid['cell_size_by_degree'])
-                                            ))
-    return polygon
-
-def point_to_index_grid(event_lat, event_lon, dic_grid):
-    indexes_lat_y = np.floor((np.float64(event_lat) - dic_grid['lat_min_y'])/ dic_grid['cell_size_by_degree'])
-    indexes_lon_x = np.floor((np.float64(event_lon) - dic_grid['lon_min_x'])/ dic_grid['cell_size_by_degree'])
-    print('...[{},{}] indexes were created to lat and lon'.format(indexes_lat_y.size, indexes_lon_x.size))
+    """ polygon of one cell, recently used cells are kept in a LRU cache """
+    return _cached_polygon(dic_grid['lat_min_y'], dic_grid['lon_min_x'], dic_grid['cell_size_by_degree'], int(index_grid_lat), int(index_grid_lon))
+
+def _grid_index(index, size):
+    """ int index in [0, size), negative indexes count from the end as in numpy """
+    index = int(index)
+    if index < 0:
+        index += size
+    if index < 0 or index >= size:
+        raise IndexError('cell index out of the grid of size {}'.format(size))
+    return index
+
+class LazyGridPolygons(object):
+    """ polygons of the cells of a grid, created on access by create_one_polygon_to_point_on_grid """
+    def __init__(self, dic_grid):
+        self.dic_grid = {label: dic_grid[label] for label in ['lat_min_y', 'lon_min_x', 'cell_size_by_degree', 'grid_size_lat_y', 'grid_size_lon_x']}
+        self.shape = (int(dic_grid['grid_size_lat_y']), int(dic_grid['grid_size_lon_x']))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            index_grid_lat, index_grid_lon = index
+            return create_one_polygon_to_point_on_grid(self.dic_grid, _grid_index(index_grid_lat, self.shape[0]), _grid_index(index_grid_lon, self.shape[1]))
+        return _LazyGridRow(self, _grid_index(index, self.shape[0]))
+
+class _LazyGridRow(object):
+    """ one row of LazyGridPolygons, so grid_polygon[index_grid_lat][index_grid_lon] works as with an array """
+    def __init__(self, polygons, index_grid_lat):
+        self.polygons = polygons
+        self.index_grid_lat = index_grid_lat
+
+    def __len__(self):
+        return self.polygons.shape[1]
+
+    def __getitem__(self, index_grid_lon):
+        return self.polygons[self.index_grid_lat, index_grid_lon]
+
+def point_to_index_grid(event_lat, event_lon, dic_grid, dtype=None):
+    """
+    Grid indexes (index_grid_lat, index_grid_lon) of the points, as float64 by default.
+    With an integer dtype they are computed as int64 without float64 index arrays, then converted to dtype.
+    """
+    if dtype is not None and np.issubdtype(dtype, np.integer):
+        indexes_lat_y = _index_grid(event_lat, dic_grid['lat_min_y'], dic_grid).astype(dtype, copy=False)
+        indexes_lon_x = _index_grid(event_lon, dic_grid['lon_min_x'], dic_grid).astype(dtype, copy=False)
+    else:
+        indexes_lat_y = np.floor((np.float64(event_lat) - dic_grid['lat_min_y'])/ dic_grid['cell_size_by_degree'])
+        indexes_lon_x = np.floor((np.float64(event_lon) - dic_grid['lon_min_x'])/ dic_grid['cell_size_by_degree'])
+        if dtype is not None:
+            indexes_lat_y, indexes_lon_x = indexes_lat_y.astype(dtype, copy=False), indexes_lon_x.astype(dtype, copy=False)
+    ut.log('...[{},{}] indexes were created to lat and lon'.format(indexes_lat_y.size, indexes_lon_x.size))
     return indexes_lat_y, indexes_lon_x
 
+def _index_grid(values, min_value, dic_grid):
+    """ int64 grid index of coordinates, computed inplace in one float64 temporary array """
+    index = np.subtract(np.asarray(values, dtype=np.float64), min_value)
+    index /= dic_grid['cell_size_by_degree']
+    np.floor(index, out=index)
+    return index.astype(np.int64)
+
+def point_to_cell_key(event_lat, event_lon, dic_grid):
+    """
+    Packed int64 cell key of each point: index_grid_lat * grid_size_lon_x + index_grid_lon.
+    Points out of the grid get the key -1.
+    """
+    index_lat = _index_grid(event_lat, dic_grid['lat_min_y'], dic_grid)
+    index_lon = _index_grid(event_lon, dic_grid['lon_min_x'], dic_grid)
+    key = index_lat * dic_grid['grid_size_lon_x'] + index_lon
+    outside = (index_lat < 0) | (index_lat >= dic_grid['grid_size_lat_y']) | (index_lon < 0) | (index_lon >= dic_grid['grid_size_lon_x'])
+    key[outside] = -1
+    ut.log('...{} cell keys were created, {} points out of the grid'.format(key.size, np.count_nonzero(outside)))
+    return key
+
+def cell_key_to_index_grid(key, dic_grid):
+    """ (index_grid_lat, index_grid_lon) of packed cell keys """
+    return np.divmod(key, dic_grid['grid_size_lon_x'])
+
+def aggregate_by_cell(df_, dic_grid, label_id=None, dic_labels=None, label_speed='speed_to_prev', label_time='time_to_prev'):
+    """
+    Aggregates of the points in each cell of the grid in one vectorized pass:
+    number of points, number of distinct ids, mean of label_speed and sum of label_time (dwell time),
+    the last two only when the columns exist (see trajutils.create_update_dist_time_speed_features), ignoring NaN.
+    Returns a dataframe with one row by cell that has points, sorted by the packed cell key.
+        Example:
+            aggregate_by_cell(df[df['datetime'].dt.hour == 8], dic_grid)
+    """
+    try:
+        ut.log('\nAggregating {} GPS points by cell'.format(df_.shape[0]))
+        start_time = time.time()
+        if dic_labels is None:
+            dic_labels = trajutils.dic_labels
+        if label_id is None:
+            label_id = dic_labels['id']
+
+        key = point_to_cell_key(df_[dic_labels['lat']].values, df_[dic_labels['lon']].values, dic_grid)
+        inside = key >= 0
+        key = key[inside]
+        grid_size = dic_grid['grid_size_lat_y'] * dic_grid['grid_size_lon_x']
+        if grid_size <= 2 * key.shape[0] + 1000000:
+            """ small grid: cells with points from one bincount over all keys, without sorting"""
+            keys = np.flatnonzero(np.bincount(key, minlength=grid_size))
+            cell_by_key = np.zeros(grid_size, dtype=np.int64)
+            cell_by_key[keys] = np.arange(keys.shape[0])
+            cell = cell_by_key[key]
+        else:
+            keys, cell = np.unique(key, return_inverse=True)
+        n_cells = keys.shape[0]
+
+        index_lat, index_lon = cell_key_to_index_grid(keys, dic_grid)
+        df_cells = pd.DataFrame({'index_grid': keys, 'index_grid_lat': index_lat, 'index_grid_lon': index_lon})
+        df_cells['count'] = np.bincount(cell, minlength=n_cells)
+
+        """ distinct (cell, id) pairs, then one count by cell"""
+        id_code, id_values = pd.factorize(df_[label_id].values[inside])
+        pairs = np.unique(cell.astype(np.int64) * max(1, id_values.shape[0]) + id_code)
+        df_cells['ids'] = np.bincount(pairs // max(1, id_values.shape[0]), minlength=n_cells)
+
+        if label_speed in df_:
+            speed = df_[label_speed].values[inside].astype(np.float64)
+            valid = ~np.isnan(speed)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                df_cells['speed_mean'] = np.bincount(cell[valid], weights=speed[valid], minlength=n_cells) / np.bincount(cell[valid], minlength=n_cells)
+        if label_time in df_:
+            time_ = df_[label_time].values[inside].astype(np.float64)
+            valid = ~np.isnan(time_)
+            df_cells['dwell_time'] = np.bincount(cell[valid], weights=time_[valid], minlength=n_cells)
+
+        ut.log('...{} cells with points, {:.3f} seconds'.format(n_cells, time.time() - start_time))
+        return df_cells
+    except Exception as e:
+        raise e
+
+def _clip_index_grid(index_grid, grid_size):
+    """ grid indexes as int64 inside [0, grid_size - 1], points out of the grid fall in the border cells """
+    return np.clip(np.floor(index_grid), 0, grid_size - 1).astype(np.int64)
+
+def create_spatial_index(df_, cell_size=100, dic_grid=None, dic_labels=None):
+    """
+    Index the GPS points of df_ by the cells of a virtual grid, to answer bbox, radius and 
+    k-nearest queries without scanning all points. The rows are sorted by cell key 
+    (index_grid_lat * grid_size_lon_x + index_grid_lon) and offsets give the rows of each key.
+    If dic_grid is None, a virtual grid with cells of cell_size meters is created over the bbox of df_.
+    Queries return row positions of df_ (use df_.iloc), so the index must be rebuilt when df_ changes.
+        Example:
+            dic_index = create_spatial_index(df, cell_size=200)
+            df.iloc[query_radius(dic_index, -3.7319, -38.5267, 500)]
+    """
+    try:
+        ut.log('\nCreating a spatial index over {} GPS points'.format(df_.shape[0]))
+        start_time = time.time()
+        if dic_labels is None:
+            dic_labels = trajutils.dic_labels
+        if dic_grid is None:
+            dic_grid = create_virtual_grid(cell_size, trajutils.get_bbox(df_, dic_labels))
+
+        lat = df_[dic_labels['lat']].values.astype(np.float64)
+        lon = df_[dic_labels['lon']].values.astype(np.float64)
+        index_lat = _clip_index_grid((lat - dic_grid['lat_min_y']) / dic_grid['cell_size_by_degree'], dic_grid['grid_size_lat_y'])
+        index_lon = _clip_index_grid((lon - dic_grid['lon_min_x']) / dic_grid['cell_size_by_degree'], dic_grid['grid_size_lon_x'])
+        key = index_lat * dic_grid['grid_size_lon_x'] + index_lon
+
+        rows = np.argsort(key, kind='stable')
+        keys, offsets = np.unique(key[rows], return_index=True)
+
+        dic_index = dict()
+        dic_index['dic_grid'] = dic_grid
+        dic_index['keys'] = keys
+        dic_index['offsets'] = np.append(offsets, rows.shape[0]).astype(np.int64)
+        dic_index['rows'] = rows
+        dic_index['lat'] = lat[rows]
+        dic_index['lon'] = lon[rows]
+        dic_index['cell_size'] = dic_grid['cell_size_by_degree'] * lat_meters(lat.mean() if lat.shape[0] > 0 else 0)
+        ut.log('...{} points in {} cells, {:.3f} seconds'.format(rows.shape[0], keys.shape[0], time.time() - start_time))
+        return dic_index
+    except Exception as e:
+        raise e
+
+def _candidates_in_bbox(dic_index, bbox):
+    """ positions, in the sorted order of dic_index, of the points in the cells that intersect bbox """
+    dic_grid = dic_index['dic_grid']
+    index_lat = _clip_index_grid((np.array([bbox[0], bbox[2]]) - dic_grid['lat_min_y']) / dic_grid['cell_size_by_degree'], dic_grid['grid_size_lat_y'])
+    index_lon = _clip_index_grid((np.array([bbox[1], bbox[3]]) - dic_grid['lon_min_x']) / dic_grid['cell_size_by_degree'], dic_grid['grid_size_lon_x'])
+
+    """ in each row of cells the keys between the first and last column are contiguous"""
+    row_keys = np.arange(index_lat[0], index_lat[1] + 1) * dic_grid['grid_size_lon_x']
+    start = dic_index['offsets'][np.searchsorted(dic_index['keys'], row_keys + index_lon[0], side='left')]
+    stop = dic_index['offsets'][np.searchsorted(dic_index['keys'], row_keys + index_lon[1], side='right')]
+
+    lengths = stop - start
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+def query_bbox(dic_index, bbox):
+    """
+    Row positions of the points inside bbox = [lat_min, lon_min, lat_max, lon_max], in ascending order.
+        Example:
+            df.iloc[query_bbox(dic_index, [-3.90, -38.67, -3.68, -38.38])]
+    """
+    candidates = _candidates_in_bbox(dic_index, bbox)
+    lat = dic_index['lat'][candidates]
+    lon = dic_index['lon'][candidates]
+    inside = (lat >= bbox[0]) & (lat <= bbox[2]) & (lon >= bbox[1]) & (lon <= bbox[3])
+    return np.sort(dic_index['rows'][candidates[inside]])
+
+def query_radius(dic_index, lat, lon, radius, return_distance=False):
+    """
+    Row positions of the points within radius meters of (lat, lon), in ascending order,
+    and their haversine distances in meters if return_distance is True.
+    """
+    earth_radius = 6371 * 1000
+    delta_lat = math.degrees(radius / earth_radius)
+    if abs(lat) + delta_lat >= 90:
+        delta_lon = 360.0
+    else:
+        delta_lon = delta_lat / math.cos(math.radians(abs(lat) + delta_lat))
+    candidates = _candidates_in_bbox(dic_index, [lat - delta_lat, lon - delta_lon, lat + delta_lat, lon + delta_lon])
+
+    dist = trajutils.haversine(dic_index['lat'][candidates], dic_index['lon'][candidates], lat, lon)
+    inside = dist <= radius
+    rows = dic_index['rows'][candidates[inside]]
+    order = np.argsort(rows)
+    if return_distance:
+        return rows[order], dist[inside][order]
+    return rows[order]
+
+def query_knn(dic_index, lat, lon, k=1):
+    """
+    Row positions of the k nearest points to (lat, lon) and their distances in meters, nearest first.
+    The search radius starts at one cell and is doubled until it holds k points.
+    """
+    radius = dic_index['cell_size']
+    max_radius = math.pi * 6371 * 1000
+    while True:
+        rows, dist = query_radius(dic_index, lat, lon, radius, return_distance=True)
+        if rows.shape[0] >= k or radius > max_radius:
+            break
+        radius *= 2
+    order = np.argsort(dist, kind='stable')[:k]
+    return rows[order], dist[order]
+
+def _spread_bits(index):
+    """ spread the 32 lower bits of index to the even bits of an int64 """
+    index = index.astype(np.int64) & 0x00000000FFFFFFFF
+    index = (index | (index << 16)) & 0x0000FFFF0000FFFF
+    index = (index | (index << 8)) & 0x00FF00FF00FF00FF
+    index = (index | (index << 4)) & 0x0F0F0F0F0F0F0F0F
+    index = (index | (index << 2)) & 0x3333333333333333
+    index = (index | (index << 1)) & 0x5555555555555555
+    return index
+
+def _compact_bits(code):
+    """ inverse of _spread_bits, the even bits of code """
+    code = code & 0x5555555555555555
+    code = (code | (code >> 1)) & 0x3333333333333333
+    code = (code | (code >> 2)) & 0x0F0F0F0F0F0F0F0F
+    code = (code | (code >> 4)) & 0x00FF00FF00FF00FF
+    code = (code | (code >> 8)) & 0x0000FFFF0000FFFF
+    code = (code | (code >> 16)) & 0x00000000FFFFFFFF
+    return code
+
+def _quadtree_code(event_lat, event_lon, dic_quadtree):
+    """ morton code of each point at max_depth (lat bits are the odd bits), and a mask of the points inside the root cell """
+    size = 1 << dic_quadtree['max_depth']
+    index_lat = (np.asarray(event_lat, dtype=np.float64) - dic_quadtree['lat_min_y']) / dic_quadtree['cell_size_by_degree'] * size
+    index_lon = (np.asarray(event_lon, dtype=np.float64) - dic_quadtree['lon_min_x']) / dic_quadtree['cell_size_by_degree'] * size
+    inside = (index_lat >= 0) & (index_lat <= size) & (index_lon >= 0) & (index_lon <= size)
+    index_lat = np.clip(np.floor(np.nan_to_num(index_lat)), 0, size - 1)
+    index_lon = np.clip(np.floor(np.nan_to_num(index_lon)), 0, size - 1)
+    return (_spread_bits(index_lat) << 1) | _spread_bits(index_lon), inside
+
+def create_quadtree_grid(df_, max_points=10000, max_depth=16, bbox=None, dic_labels=None):
+    """
+    Multi-resolution grid: a quadtree over the bbox of the points (or the given bbox), where a cell is split
+    in four while it has more than max_points points and its depth is lower than max_depth (at most 30).
+    The cell of depth d and morton prefix p holds the points whose morton code at max_depth
+    starts with p, so each level is counted from the sorted codes with two searchsorted calls.
+    Returns a dictionary with the root cell and the leaves sorted by code, the leaves cover the whole root cell.
+        Example:
+            dic_quadtree = create_quadtree_grid(df, max_points=5000)
+            df['leaf'] = point_to_quadtree_leaf(df['lat'], df['lon'], dic_quadtree)
+    """
+    try:
+        ut.log('\nCreating a quadtree grid with at most {} points by cell'.format(max_points))
+        start_time = time.time()
+        if max_depth > 30:
+            raise ValueError('max_depth must be at most 30, not {}'.format(max_depth))
+        if dic_labels is None:
+            dic_labels = trajutils.dic_labels
+        if bbox is None:
+            bbox = trajutils.get_bbox(df_, dic_labels)
+
+        dic_quadtree = dict()
+        dic_quadtree['lat_min_y'] = bbox[0]
+        dic_quadtree['lon_min_x'] = bbox[1]
+        dic_quadtree['cell_size_by_degree'] = max(bbox[2] - bbox[0], bbox[3] - bbox[1], 1e-9) * (1 + 1e-9)
+        dic_quadtree['max_depth'] = max_depth
+        dic_quadtree['max_points'] = max_points
+
+        code, inside = _quadtree_code(df_[dic_labels['lat']].values, df_[dic_labels['lon']].values, dic_quadtree)
+        code = np.sort(code[inside])
+
+        leaf_depth = []
+        leaf_prefix = []
+        leaf_count = []
+        prefix = np.zeros(1, dtype=np.int64)
+        for depth in range(max_depth + 1):
+            shift = 2 * (max_depth - depth)
+            count = np.searchsorted(code, (prefix + 1) << shift) - np.searchsorted(code, prefix << shift)
+            split = count > max_points if depth < max_depth else np.zeros(prefix.shape[0], dtype=np.bool_)
+            leaf_depth.append(np.full(np.count_nonzero(~split), depth, dtype=np.int8))
+            leaf_prefix.append(prefix[~split])
+            leaf_count.append(count[~split])
+            prefix = (prefix[split][:, np.newaxis] * 4 + np.arange(4, dtype=np.int64)).ravel()
+            if prefix.shape[0] == 0:
+                break
+
+        leaf_depth = np.concatenate(leaf_depth)
+        leaf_prefix = np.concatenate(leaf_prefix)
+        leaf_start = leaf_prefix << (2 * (max_depth - leaf_depth.astype(np.int64)))
+        order = np.argsort(leaf_start, kind='stable')
+        dic_quadtree['leaf_depth'] = leaf_depth[order]
+        dic_quadtree['leaf_prefix'] = leaf_prefix[order]
+        dic_quadtree['leaf_start'] = leaf_start[order]
+        dic_quadtree['leaf_count'] = np.concatenate(leaf_count)[order]
+        ut.log('...{} leaves up to depth {}, the largest with {} points, {:.3f} seconds'.format(
+            order.shape[0], leaf_depth.max(), dic_quadtree['leaf_count'].max(), time.time() - start_time))
+        return dic_quadtree
+    except Exception as e:
+        raise e
+
+def point_to_quadtree_leaf(event_lat, event_lon, dic_quadtree):
+    """ position of the leaf of each point in the leaves of dic_quadtree, -1 to points out of the root cell """
+    code, inside = _quadtree_code(event_lat, event_lon, dic_quadtree)
+    leaf = np.searchsorted(dic_quadtree['leaf_start'], code, side='right') - 1
+    leaf[~inside] = -1
+    return leaf
+
+def quadtree_leaf_bbox(dic_quadtree):
+    """ dataframe with depth, lat_min, lon_min, lat_max, lon_max and count of each leaf """
+    depth = dic_quadtree['leaf_depth'].astype(np.int64)
+    prefix = dic_quadtree['leaf_prefix']
+    size = dic_quadtree['cell_size_by_degree'] / (1 << depth)
+    lat_min = dic_quadtree['lat_min_y'] + _compact_bits(prefix >> 1) * size
+    lon_min = dic_quadtree['lon_min_x'] + _compact_bits(prefix) * size
+    return pd.DataFrame({'depth': depth, 'lat_min': lat_min, 'lon_min': lon_min, 'lat_max': lat_min + size, 
+                         'lon_max': lon_min + size, 'count': dic_quadtree['leaf_count']})
+
+def aggregate_quadtree(dic_quadtree, leaf_values=None):
+    """
+    Sum leaf_values (by default the number of points of each leaf) up the hierarchy.
+    Returns a dataframe with one row by cell of each depth, with its depth, morton prefix and sum;
+    a leaf is also counted in the deeper levels, as it is not split there.
+    """
+    if leaf_values is None:
+        leaf_values = dic_quadtree['leaf_count']
+    leaf_depth = dic_quadtree['leaf_depth'].astype(np.int64)
+    leaf_prefix = dic_quadtree['leaf_prefix']
+
+    leaf_values = np.asarray(leaf_values)
+    levels = []
+    for depth in range(int(leaf_depth.max()) + 1):
+        """ ancestor at depth, or the leaf itself when it is not so deep, keyed by its first code"""
+        cell_depth = np.minimum(leaf_depth, depth)
+        prefix = leaf_prefix >> (2 * (leaf_depth - cell_depth))
+        start = prefix << (2 * (dic_quadtree['max_depth'] - cell_depth))
+        _, first, cell = np.unique(start, return_index=True, return_inverse=True)
+        value = np.bincount(cell, weights=leaf_values, minlength=first.shape[0])
+        if leaf_values.dtype.kind in 'biu':
+            value = value.astype(np.int64)
+        levels.append(pd.DataFrame({'level': depth, 'depth': cell_depth[first], 'prefix': prefix[first], 'value': value}))
+    return pd.concat(levels, ignore_index=True)
+
+"""
+binary grid format: GRID_MAGIC, format version (uint32), header size (uint32), json header
+with the grid parameters and the dtype, shape and offset of each array, then the raw arrays 
+aligned to GRID_ALIGNMENT bytes, so they can be opened with np.memmap
+"""
+GRID_MAGIC = b'PYMOVEGRID'
+GRID_FORMAT_VERSION = 1
+GRID_ALIGNMENT = 64
+GRID_PARAMETERS = ['lon_min_x', 'lat_min_y', 'grid_size_lat_y', 'grid_size_lon_x', 'cell_size_by_degree']
+
+def _align(offset):
+    return (offset + GRID_ALIGNMENT - 1) // GRID_ALIGNMENT * GRID_ALIGNMENT
+
+def save_grid(filename, dic_grid, aggregates=None):
+    """
+    Save the grid parameters and, optionally, per-cell arrays in the binary grid format.
+    aggregates is a dict of numeric arrays or a dataframe, like the one returned by aggregate_by_cell.
+    Polygons are not saved, they are created again only for the cells needed (see create_polygons_on_grid).
+        Example:
+            save_grid('grid.pmg', dic_grid, aggregate_by_cell(df, dic_grid))
+    """
+    try:
+        arrays = {}
+        if aggregates is not None:
+            for label in aggregates:
+                arrays[label] = np.ascontiguousarray(aggregates[label])
+                if arrays[label].dtype.kind not in 'biuf':
+                    raise ValueError('aggregate {} must be numeric, not {}'.format(label, arrays[label].dtype))
+
+        header = {'grid': {label: dic_grid[label] for label in GRID_PARAMETERS}, 'arrays': {}}
+        offset = 0
+        for label, values in arrays.items():
+            header['arrays'][label] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+            offset = _align(offset + values.nbytes)
+        header_bytes = json.dumps(header, default=lambda value: value.item()).encode('utf-8')
+
+        start = _align(len(GRID_MAGIC) + 8 + len(header_bytes))
+        with open(filename, 'wb') as f:
+            f.write(GRID_MAGIC)
+            f.write(np.array([GRID_FORMAT_VERSION, len(header_bytes)], dtype='<u4').tobytes())
+            f.write(header_bytes)
+            for label, values in arrays.items():
+                f.seek(start + header['arrays'][label]['offset'])
+                f.write(values.tobytes())
+            f.truncate(start + offset)
+        ut.log('\nA grid file was saved with {} arrays'.format(len(arrays)))
+    except Exception as e:
+        raise e
+
+def read_grid(filename, mmap=True):
+    """
+    Read a grid saved by save_grid. The per-cell arrays are in dic_grid['aggregates'], opened with
+    np.memmap (read only), so many processes share the same pages, or loaded in memory if mmap is False.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(len(GRID_MAGIC)) != GRID_MAGIC:
+                raise ValueError('{} is not a grid file'.format(filename))
+            version, header_size = np.frombuffer(f.read(8), dtype='<u4')
+            if version > GRID_FORMAT_VERSION:
+                raise ValueError('{} has grid format version {}, this version reads up to {}'.format(filename, version, GRID_FORMAT_VERSION))
+            header = json.loads(f.read(int(header_size)).decode('utf-8'))
+
+        start = _align(len(GRID_MAGIC) + 8 + int(header_size))
+        dic_grid = dict(header['grid'])
+        dic_grid['aggregates'] = {}
+        for label, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                values = np.zeros(shape, dtype=spec['dtype'])
+            elif mmap:
+                values = np.memmap(filename, dtype=spec['dtype'], mode='r', offset=start + spec['offset'], shape=shape)
+            else:
+                values = np.fromfile(filename, dtype=spec['dtype'], count=int(np.prod(shape)), offset=start + spec['offset']).reshape(shape)
+            dic_grid['aggregates'][label] = values
+        return dic_grid
+    except Exception as e:
+        raise e
+
 def save_grid_pkl(filename, dic_grid):
     """ex: save_grid(grid_file, my_dict_grid)"""
     try:
         f = open(filename,"wb")
         pickle.dump(dic_grid,f)
         f.close()
-        print('\nA file was saved')
+        ut.log('\nA file was saved')
     except Exception as e:
         raise e
 
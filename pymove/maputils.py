@@ -2,12 +2,15 @@ import matplotlib
 import matplotlib.pyplot as plt
 import colorsys
 import numpy as np
+import pandas as pd
+import json
 import folium
 from folium.plugins import HeatMap, HeatMapWithTime
 from matplotlib.colors import LinearSegmentedColormap
 import itertools
 
 from pymove import trajutils
+from pymove import utils as ut
 
 # http://www.color-hex.com/color/
 
@@ -25,41 +28,79 @@ def hexRgb(RGBcolors):
 def cmap_hex_color(cmap, i):
     return matplotlib.colors.rgb2hex(cmap(i))
 
+def _iter_by_id(ids, *columns):
+    """
+    Walk the values of columns grouped by ids once, yielding (position of the id, id, slice of each column)
+    in the order of pd.unique(ids), with the slices taken from contiguous arrays.
+    Points without id are left out, as in a groupby.
+    """
+    valid = ~pd.isna(ids)
+    if not valid.all():
+        ids = ids[valid]
+        columns = [values[valid] for values in columns]
+    order, first, _ = trajutils._group_bounds(ids)
+    if order is not None:
+        ids = ids[order]
+        columns = [values[order] for values in columns]
+    bounds = np.append(np.flatnonzero(first), ids.shape[0])
+    for i in range(bounds.shape[0] - 1):
+        start, stop = bounds[i], bounds[i + 1]
+        yield (i, ids[start]) + tuple(values[start:stop] for values in columns)
+
+def _write_lines(file_str, header, lines, footer='', buffer_size=10000):
+    """ write header, the lines from an iterator, buffer_size at a time, and footer """
+    with open(file_str, 'w') as f:
+        f.write(header)
+        buffer = []
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) == buffer_size:
+                f.writelines(buffer)
+                buffer = []
+        f.writelines(buffer)
+        f.write(footer)
+
 def save_map(df, file, tiles='OpenStreetMap', label_id=trajutils.dic_labels['id'], dic_labels = trajutils.dic_labels, cmap='tab20'):
-    #df['lat'] = df['lat'].astype('float64')
-    #df['lon'] = df['lon'].astype('float64')
     m = folium.Map(tiles=tiles)
-    m.fit_bounds([ [df[trajutils.dic_labels['lat']].min(), df[trajutils.dic_labels['lon']].min()], [df[trajutils.dic_labels['lat']].max(), df[trajutils.dic_labels['lon']].max()] ])
-    
-    ids = df[label_id].unique()
+    m.fit_bounds([ [df[dic_labels['lat']].min(), df[dic_labels['lon']].min()], [df[dic_labels['lat']].max(), df[dic_labels['lon']].max()] ])
     
-    #vals = np.linspace(0,1,256)
-    #np.random.seed(color_seed)
-    #np.random.shuffle(vals)
-    #cmap_ = plt.cm.colors.ListedColormap(plt.cm.hsv(vals))
-    # cmap_ = plt.cm.get_cmap( base_cmap, lut=ids.shape[0] )
     cmap_ = plt.cm.get_cmap( cmap )
     N = cmap_.N
+    colors = [cmap_hex_color(cmap_, i) for i in range(N)]
     
-    for id_ in ids:
-        id_index = np.where(ids==id_)[0][0]
-        df_ = df[ df[label_id] == id_ ]
-        #print('id:{}, shape:{}'.format(id_, df_.shape))
-        points_ = [ (point[0], point[1]) for point in df_[[trajutils.dic_labels['lat'], trajutils.dic_labels['lon']]].values]
-        color_ = cmap_hex_color(cmap_, (id_index % N))
-        #print( 'id_index:{}, color:{}'.format(id_index, color_) )
-        folium.PolyLine(points_, weight=3, color=color_).add_to(m)
+    for id_index, _, lat, lon in _iter_by_id(df[label_id].values, df[dic_labels['lat']].values, df[dic_labels['lon']].values):
+        folium.PolyLine(np.column_stack([lat, lon]).tolist(), weight=3, color=colors[id_index % N]).add_to(m)
     m.save(file) 
-  
+
+def _coordinates(values):
+    """ 
+    values to format: python floats for float64, the fastest, and the str of the numpy scalars otherwise,
+    which keeps the shortest repr of their own precision (e.g. -3.8162973 for float32)
+    """
+    return values.tolist() if values.dtype == np.float64 else [str(value) for value in values]
+
+def _points_str(df, dic_labels, point_format):
+    """ each point formatted once as point_format.format(lon, lat), in a numpy array of objects """
+    return np.array([point_format.format(lon, lat) for lon, lat in zip(_coordinates(df[dic_labels['lon']].values), _coordinates(df[dic_labels['lat']].values))], dtype=object)
+
+def _iter_points_str(df, label_id, dic_labels, point_format):
+    """ (id, list of formatted points) of each id, see _iter_by_id """
+    for _, id_, points in _iter_by_id(df[label_id].values, _points_str(df, dic_labels, point_format)):
+        yield id_, points.tolist()
+
 def save_wkt(df, file_str, label_id=trajutils.dic_labels['id'], dic_labels=trajutils.dic_labels):
-    str_ = '{};linestring\n'.format(label_id)
-    ids = df[label_id].unique()
-    for id_ in ids:
-        df_ = df[ df[label_id] == id_ ]
-        str_ += '{};LINESTRING('.format(id_)
-        str_ += ','.join('{} {}'.format(x[0],x[1]) for x in df_[dic_labels['lon'], dic_labels['lat']].values)
-        str_ += ')\n'
-    open(file_str, "w").write(str_)    
+    """ one line id;LINESTRING(lon lat,...) by id, written to the file as the points are walked """
+    lines = ('{};LINESTRING({})\n'.format(id_, ','.join(points)) for id_, points in _iter_points_str(df, label_id, dic_labels, '{} {}'))
+    _write_lines(file_str, '{};linestring\n'.format(label_id), lines)
+
+def save_geojson(df, file_str, label_id=trajutils.dic_labels['id'], dic_labels=trajutils.dic_labels):
+    """ GeoJSON FeatureCollection with one LineString feature by id, written to the file as the points are walked """
+    def feature(id_, points):
+        properties = json.dumps({label_id: id_.item() if hasattr(id_, 'item') else id_}, default=str)
+        return '{{"type": "Feature", "properties": {}, "geometry": {{"type": "LineString", "coordinates": [{}]}}}}'.format(properties, ', '.join(points))
+    features = _iter_points_str(df, label_id, dic_labels, '[{}, {}]')
+    lines = ('{}{}'.format(',\n' if i > 0 else '', feature(id_, points)) for i, (id_, points) in enumerate(features))
+    _write_lines(file_str, '{"type": "FeatureCollection", "features": [\n', lines, '\n]}\n')
     
 def invert_map(map_):
     inv_map = {}
@@ -182,43 +223,118 @@ def generateBaseMap(default_location, default_zoom_start=12):
     base_map = folium.Map(location=default_location, control_scale=True, zoom_start=default_zoom_start)
     return base_map
 
-def heatmap(df_, n_rows, lat_origin=None, lon_origin=None, zoom_start=12, radius = 8, max_zoom = 13, base_map=None, save_as_html=False, filename='heatmap.html'):
+""" meters of a pixel of the web mercator map tiles at zoom 0, and the offset of x and y to the corner of the map """
+MERCATOR_PIXEL = 2 * np.pi * 6378137 / 256
+MERCATOR_OFFSET = np.pi * 6378137
+MERCATOR_MAX_LAT = 85.0511287798
+
+def _heatmap_cells_xy(lat, lon, zoom, cell_pixels):
+    """ column and row of the heatmap cell of each point, in cells of cell_pixels pixels of the tiles at zoom """
+    cell_size = MERCATOR_PIXEL / 2 ** zoom * cell_pixels
+    x = trajutils.lon2XSpherical(lon) + MERCATOR_OFFSET
+    y = trajutils.lat2YSpherical(np.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)) + MERCATOR_OFFSET
+    return np.floor(x / cell_size).astype(np.int64), np.floor(y / cell_size).astype(np.int64)
+
+def _time_buckets(datetime, time_bucket):
+    """ bucket of each datetime: an attribute of Series.dt (e.g. 'hour', 'dayofweek') or a frequency to floor to (e.g. '15min', 'D') """
+    if hasattr(pd.Series.dt, time_bucket):
+        return getattr(datetime.dt, time_bucket)
+    return datetime.dt.floor(time_bucket)
+
+def heatmap_cells(df_, zoom=13, cell_pixels=2, max_cells=200000, time_bucket=None, dic_labels=trajutils.dic_labels):
+    """
+    Aggregate the points into square cells of cell_pixels pixels of the map tiles at zoom, 
+    returning a dataframe with the mean lat and lon of the points of each cell and their count,
+    ready for HeatMap (see heatmap). While there are more than max_cells cells, cells twice as large 
+    (one zoom level less) are used, so millions of points render from at most max_cells weighted cells.
+    With time_bucket ('hour', 'dayofweek', ... or a frequency like '15min'), cells are per time bucket, 
+    in a first column 'bucket', and max_cells counts the cells of all buckets. Points without a finite lat
+    and lon (or without datetime, with time_bucket) are left out. The cells are of a single zoom level,
+    the one returned by the log, not a pyramid: call it again with another zoom for other levels.
+    df_ is not changed.
+        Example:
+            cells = heatmap_cells(df, zoom=12, time_bucket='hour')
+    """
+    try:
+        lat = df_[dic_labels['lat']].values.astype(np.float64)
+        lon = df_[dic_labels['lon']].values.astype(np.float64)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        if time_bucket is not None:
+            datetime = df_[dic_labels['datetime']]
+            valid &= datetime.notna().values
+        if not valid.all():
+            ut.log('...{} points without finite lat and lon or datetime left out'.format(valid.shape[0] - valid.sum()))
+            lat, lon = lat[valid], lon[valid]
+        col, row = _heatmap_cells_xy(lat, lon, zoom, cell_pixels)
+
+        """ the points are factorized once by (bucket, cell at zoom), then only these pairs are coarsened """
+        codes, uniques = pd.factorize(row << 32 | col)
+        n_uniques = uniques.shape[0]
+        if time_bucket is not None:
+            buckets, bucket_values = pd.factorize(_time_buckets(datetime[valid], time_bucket), sort=True)
+            pairs, pair_keys = pd.factorize(buckets.astype(np.int64) * n_uniques + codes)
+            pair_bucket, pair_cell = np.divmod(pair_keys, n_uniques)
+        else:
+            pairs, pair_bucket, pair_cell = codes, np.zeros(n_uniques, dtype=np.int64), np.arange(n_uniques)
+
+        cell_row, cell_col = uniques >> 32, uniques & 0xFFFFFFFF
+        cell_map = np.arange(n_uniques)
+        pair_map, pair_keys = pd.factorize(pair_bucket * n_uniques + cell_map[pair_cell])
+        while pair_keys.shape[0] > max_cells and zoom > 0:
+            zoom -= 1
+            cell_row, cell_col = cell_row >> 1, cell_col >> 1
+            cell_map = pd.factorize(cell_row << 32 | cell_col)[0]
+            pair_map, pair_keys = pd.factorize(pair_bucket * n_uniques + cell_map[pair_cell])
+        if pair_keys.shape[0] > max_cells:
+            ut.log('...{} cells at zoom 0, more than max_cells {}'.format(pair_keys.shape[0], max_cells))
+
+        cells = pair_map[pairs]
+        count = np.bincount(cells, minlength=pair_keys.shape[0])
+        result = pd.DataFrame({dic_labels['lat']: np.bincount(cells, weights=lat, minlength=count.shape[0]) / count,
+                               dic_labels['lon']: np.bincount(cells, weights=lon, minlength=count.shape[0]) / count,
+                               'count': count})
+        if time_bucket is not None:
+            result.insert(0, 'bucket', np.asarray(bucket_values)[pair_keys // n_uniques])
+            result.sort_values('bucket', kind='mergesort', inplace=True)
+            result.reset_index(drop=True, inplace=True)
+        ut.log('...{} points in {} cells at zoom {}'.format(lat.shape[0], result.shape[0], zoom))
+        return result
+    except Exception as e:
+        raise e
+
+def heatmap(df_, n_rows, lat_origin=None, lon_origin=None, zoom_start=12, radius = 8, max_zoom = 13, base_map=None, save_as_html=False, filename='heatmap.html',
+            cell_pixels=2, max_cells=200000):
+    """ HeatMap of the rows up to n_rows, aggregated in cells at max_zoom by heatmap_cells """
     if base_map is None:
         if lat_origin is None and lon_origin is None:
             lat_origin = df_.loc[0]['lat']
             lon_origin = df_.loc[0]['lon']
         base_map = generateBaseMap(default_location=[lat_origin, lon_origin], default_zoom_start=zoom_start)
 
-    COUNT = 'count'
-    df_[COUNT] = 1
-    HeatMap(data=df_.loc[:n_rows, ['lat', 'lon', COUNT]].groupby(['lat', 'lon']).sum().reset_index().values.tolist(),
-        radius=radius, max_zoom=max_zoom).add_to(base_map)
-    df_.drop(columns=[COUNT], inplace=True)
+    cells = heatmap_cells(df_.loc[:n_rows], max_zoom, cell_pixels, max_cells)
+    HeatMap(data=cells[['lat', 'lon', 'count']].values.tolist(), radius=radius, max_zoom=max_zoom).add_to(base_map)
     if save_as_html:
         base_map.save(outfile=filename)
     else:
         return base_map
 
 def heatmap_with_time(df_, n_rows, lat_origin=None, lon_origin=None, zoom_start=12, radius = 5, min_opacity = 0.5, max_opacity = 0.8, base_map=None, save_as_html=False,
-                      filename='heatmap_with_time.html'):
+                      filename='heatmap_with_time.html', max_zoom=13, cell_pixels=2, max_cells=200000, time_bucket='hour'):
+    """ HeatMapWithTime of the first n_rows time buckets (hours of the day by default), aggregated in cells at max_zoom by heatmap_cells """
     if base_map is None:
         if lat_origin is None and lon_origin is None:
             lat_origin = df_.loc[0]['lat']
             lon_origin = df_.loc[0]['lon']
         base_map = generateBaseMap(default_location=[lat_origin, lon_origin], default_zoom_start=zoom_start)
-    COUNT = 'count'
-    df_['hour'] = df_.datetime.apply(lambda x: x.hour)
-    df_[COUNT] = 1
-    df_hour_list = []
-    for hour in df_.hour.sort_values().unique():
-        df_hour_list.append(df_.loc[df_.hour == hour, ['lat', 'lon', COUNT]].groupby(
-            ['lat', 'lon']).sum().reset_index().values.tolist())
+
+    cells = heatmap_cells(df_, max_zoom, cell_pixels, max_cells, time_bucket)
+    bounds = np.flatnonzero(cells['bucket'].values[1:] != cells['bucket'].values[:-1]) + 1
+    df_hour_list = [values.tolist() for values in np.split(cells[['lat', 'lon', 'count']].values, bounds)] if cells.shape[0] > 0 else []
 
     HeatMapWithTime(df_hour_list[:n_rows], radius=radius, gradient={0.2: 'blue', 0.4: 'lime', 0.6: 'orange', 1: 'red'},
                     min_opacity=min_opacity, max_opacity=max_opacity, use_local_extrema=True).add_to(base_map)
 
-    df_.drop(columns=[COUNT, 'hour'], inplace=True)
     if save_as_html:
         base_map.save(outfile=filename)
     else:
-        return base_map
\ No newline at end of file
+        return base_map
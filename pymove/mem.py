@@ -6,6 +6,8 @@ import pandas as pd
 import numpy as np
 import json
 import resource
+from pymove import trajutils
+from pymove import utils as ut
 
 def get_proc_info():
     UID = 1
@@ -78,41 +80,91 @@ def mem():
     mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
     return mem # used memory in MB
 
-def reduce_mem_usage_automatic(df):
-    start_mem = df.memory_usage().sum() / 1024**2
-    print('Memory usage of dataframe is {:.2f} MB'.format(start_mem))
-
-    for col in df.columns:
-        col_type = df[col].dtype
-        if str(col_type) == 'int':
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                df[col] = df[col].astype(np.int8)
-            elif c_min > np.iinfo(np.uint8).min and c_max < np.iinfo(np.uint8).max:
-                df[col] = df[col].astype(np.uint8)
-            elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                df[col] = df[col].astype(np.int16)
-            elif c_min > np.iinfo(np.uint16).min and c_max < np.iinfo(np.uint16).max:
-                df[col] = df[col].astype(np.uint16)
-            elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                df[col] = df[col].astype(np.int32)
-            elif c_min > np.iinfo(np.uint32).min and c_max < np.iinfo(np.uint32).max:
-                df[col] = df[col].astype(np.uint32)                    
-            elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                df[col] = df[col].astype(np.int64)
-            elif c_min > np.iinfo(np.uint64).min and c_max < np.iinfo(np.uint64).max:
-                df[col] = df[col].astype(np.uint64)
-        elif col_type == np.float:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                df[col] = df[col].astype(np.float16)
-            elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                df[col] = df[col].astype(np.float32)
-            else:
-                df[col] = df[col].astype(np.float64)
-
-    end_mem = df.memory_usage().sum() / 1024**2
-    print('Memory usage after optimization is: {:.2f} MB'.format(end_mem))
-    print('Decreased by {:.1f}%'.format(100 * (start_mem - end_mem) / start_mem))
\ No newline at end of file
+""" string features of trajutils with few distinct values, always converted to category """
+CATEGORY_LABELS = [trajutils.dic_features_label['day'], trajutils.dic_features_label['period'], trajutils.dic_features_label['situation']]
+
+""" integer dtypes tried in order, the first that holds the range of a column is taken """
+INT_DTYPES = [np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64, np.uint64]
+
+def _column_memory(series):
+    return series.memory_usage(index=False, deep=True)
+
+def _downcast_int(values):
+    """ smallest integer dtype in INT_DTYPES that holds the min and max of values, None if it is their dtype """
+    if values.shape[0] == 0:
+        return None
+    # python ints, as numpy compares uint64 with int64 bounds as float64
+    c_min, c_max = int(values.min()), int(values.max())
+    for dtype in INT_DTYPES:
+        if c_min >= int(np.iinfo(dtype).min) and c_max <= int(np.iinfo(dtype).max):
+            return np.dtype(dtype) if np.dtype(dtype) != values.dtype else None
+    return None
+
+def _downcast_float(values, precision=None, rtol=0.0):
+    """
+    float32 when the values fit in its range and none of them moves more than precision if it is given, 
+    otherwise more than rtol times its value (0 for exact values), else None. float16 is never used.
+    """
+    if values.dtype.itemsize <= 4:
+        return None
+    finite = values[np.isfinite(values)]
+    if finite.shape[0] > 0 and np.abs(finite).max() > np.finfo(np.float32).max:
+        return None
+    if finite.shape[0] > 0:
+        error = np.abs(finite.astype(np.float32) - finite)
+        if np.any(error > (precision if precision is not None else rtol * np.abs(finite))):
+            return None
+    return np.dtype(np.float32)
+
+def reduce_mem_usage_automatic(df, dic_labels=trajutils.dic_labels, lat_lon_precision=1e-5, category_labels=CATEGORY_LABELS, 
+                               category_ratio=0.5, float_rtol=0.0, inplace=True):
+    """
+    Downcast the columns of df to the smallest dtypes that keep their values, visiting each column once:
+        integer columns (of any size) to the smallest integer dtype that holds their range,
+        lat and lon to float32 only when no coordinate moves more than lat_lon_precision degrees (1e-5 is about 1 meter),
+        other float columns to float32 only when no value changes by more than float_rtol times itself 
+        (0 by default, so only values exact in float32, and timestamps or distances are never rounded),
+        the id and category_labels (day, period, situation) to category, so the ids are factorized into integer codes,
+        other string columns to category when they have at most category_ratio distinct values per row.
+    Returns (df, report): df is changed inplace unless inplace=False, when it is an optimized copy, and 
+    report is a dataframe with the dtypes and memory in MB of each changed column before and after.
+    """
+    try:
+        start_mem = df.memory_usage(deep=True).sum() / 1024**2
+        ut.log('Memory usage of dataframe is {:.2f} MB'.format(start_mem))
+        if not inplace:
+            df = df.copy()
+
+        end_mem = start_mem
+        lat_lon = [dic_labels['lat'], dic_labels['lon']]
+        category_labels = set(category_labels) | set([dic_labels['id']])
+        report = []
+        for col in df.columns:
+            series = df[col]
+            col_type = series.dtype
+            new_type = None
+            if pd.api.types.is_bool_dtype(col_type) or not isinstance(col_type, np.dtype):
+                continue
+            elif col_type.kind in 'iu':
+                new_type = _downcast_int(series.values)
+            elif col_type.kind == 'f':
+                new_type = _downcast_float(series.values, lat_lon_precision if col in lat_lon else None, float_rtol)
+            elif col_type.kind == 'O':
+                if col in category_labels or series.nunique(dropna=False) <= category_ratio * series.shape[0]:
+                    new_type = 'category'
+            if new_type is None:
+                continue
+
+            mem_before = _column_memory(series)
+            df[col] = series.astype(new_type)
+            mem_after = _column_memory(df[col])
+            report.append([col, str(col_type), str(df[col].dtype), mem_before / 1024**2, mem_after / 1024**2])
+            end_mem -= (mem_before - mem_after) / 1024**2
+            ut.log('...{}: {} -> {}, {:.2f} MB -> {:.2f} MB'.format(col, col_type, df[col].dtype, mem_before / 1024**2, mem_after / 1024**2))
+
+        ut.log('Memory usage after optimization is: {:.2f} MB'.format(end_mem))
+        ut.log('Decreased by {:.1f}%'.format(100 * (start_mem - end_mem) / start_mem if start_mem > 0 else 0))
+        report = pd.DataFrame(report, columns=['column', 'dtype_before', 'dtype_after', 'mb_before', 'mb_after'])
+        return df, report
+    except Exception as e:
+        raise e
@@ -1,7 +1,13 @@
+import os
+import json
+import hashlib
+import sqlite3
 from xml.etree import ElementTree as ET
 import pandas as pd
 import numpy as np
-from time import time
+from time import time, sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pymove import utils as ut
 
 try:
@@ -10,35 +16,147 @@ except ImportError:
     pass
 
 
-def getinfo_osm(edges):
-    edges_unique = np.unique(edges)
-    edges_str = ','.join(map(str, edges_unique))
-    api = ovp.Overpass()
-    return api.query('[out:json];way(id:{});out tags;'.format(edges_str))
+def overpass_backend(url=None):
+    """
+    Backend of getinfo_osm that queries an Overpass API (the public one by default, or a local server at url).
+    A backend receives a list of way ids and returns a dict {way_id: {tag: value}} with the ways found.
+    """
+    def query(way_ids):
+        api = ovp.Overpass() if url is None else ovp.Overpass(url=url)
+        result = api.query('[out:json];way(id:{});out tags;'.format(','.join(map(str, way_ids))))
+        return {way.id: dict(way.tags) for way in result.ways}
+    return query
 
 
-def generate_df_edges(osm_result, cols=['lanes', 'maxspeed']):
-    rows_size = len(osm_result.ways)
-    cols_size = len(cols)
-    info_edges = np.empty((rows_size, cols_size), dtype=np.float64)
-    id_edges = np.empty((rows_size,), dtype=np.int64)
+def osm_file_backend(osm_xml_file, cache_file=None):
+    """ Backend of getinfo_osm that reads the ways of a local OSM file, through its tag cache (see build_osm_tag_cache) """
+    cache_file = build_osm_tag_cache(osm_xml_file, None, cache_file)
+    def query(way_ids):
+        df_tags = get_ways_tags_from_cache(cache_file, way_ids, _all_cached_keys(cache_file))
+        result = {}
+        for way_id, key, value in df_tags.itertuples(index=False):
+            result.setdefault(way_id, {})[key] = value
+        return result
+    return query
+
+
+def _all_cached_keys(cache_file):
+    con = sqlite3.connect(cache_file)
+    try:
+        return [key for key, in con.execute('SELECT DISTINCT key FROM way_tags')]
+    finally:
+        con.close()
+
+
+def _rate_limiter(max_requests_per_second):
+    """ function that blocks until the next request is allowed, shared by all threads """
+    lock = threading.Lock()
+    next_time = [0.0]
+    def wait():
+        with lock:
+            now = time()
+            delay = next_time[0] - now
+            next_time[0] = max(now, next_time[0]) + 1.0 / max_requests_per_second
+        if delay > 0:
+            sleep(delay)
+    return wait
+
+
+def _query_with_retry(backend, way_ids, wait, retries, retry_timeout):
+    for attempt in range(retries + 1):
+        wait()
+        try:
+            return backend(way_ids)
+        except Exception as e:
+            if attempt == retries:
+                raise e
+            ut.log('...batch of {} ways failed ({}), retrying in {} seconds'.format(len(way_ids), e, retry_timeout * 2 ** attempt))
+            sleep(retry_timeout * 2 ** attempt)
+
+
+def _open_ways_cache(cache_file):
+    """ cache of getinfo_osm, in tables of its own so the file can also hold the way_tags of build_osm_tag_cache """
+    con = sqlite3.connect(cache_file)
+    con.execute('CREATE TABLE IF NOT EXISTS fetched_ways (way_id INTEGER PRIMARY KEY, found INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS fetched_way_tags (way_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (way_id, key)) WITHOUT ROWID')
+    return con
 
-    for i, way in enumerate(osm_result.ways):
-        id_edges[i] = way.id
-        for j, col in enumerate(cols):
-            if col in way.tags:
-                info_edges[i, j] = way.tags[col]
-            else:
-                info_edges[i, j] = np.nan 
 
-    df_edges = pd.DataFrame(info_edges, columns=cols)
-    df_edges['osm_edge_id'] = id_edges
-    return df_edges[ list(df_edges.columns[-1:]) + list(df_edges.columns[:-1]) ]
+def _overpy_result(ways):
+    """ overpy Result with a Way (without nodes) for each way of a dict {way_id: {tag: value}} """
+    result = ovp.Result()
+    for way_id, tags in ways.items():
+        result.append(ovp.Way(way_id=way_id, tags=tags, node_ids=[], attributes={}, result=result))
+    return result
+
+
+def getinfo_osm(edges, backend=None, batch_size=500, n_threads=4, max_requests_per_second=1.0, retries=3, retry_timeout=5.0, cache_file=None,
+                as_overpy=False):
+    """
+    Tags of the OSM ways in edges, as a dict {way_id: {tag: value}} with the ways found, or with as_overpy=True 
+    as an overpy Result with these ways (only their tags, without nodes), the type returned before.
+    The unique ids are split in batches of batch_size sent by n_threads threads, with at most 
+    max_requests_per_second requests and retries with exponential backoff.
+    backend is overpass_backend() by default, or any function from a list of ids to a dict of tags, 
+    like osm_file_backend('fortaleza.osm.xml'). If cache_file is given, the ways already fetched 
+    (found or not) are read from this SQLite file and the new ones are saved as each batch arrives.
+        Example:
+            generate_df_edges(getinfo_osm(df['osm_edge_id'], cache_file='ways.sqlite'))
+    """
+    if backend is None:
+        backend = overpass_backend()
+    edges_unique = [int(edge) for edge in pd.unique(np.asarray(edges).ravel())]
+    result = {}
+    con = None
+    try:
+        if cache_file is not None:
+            con = _open_ways_cache(cache_file)
+            con.execute('CREATE TEMP TABLE query_ids (way_id INTEGER PRIMARY KEY)')
+            con.executemany('INSERT OR IGNORE INTO query_ids VALUES (?)', ((edge,) for edge in edges_unique))
+            cached = set()
+            for way_id, found in con.execute('SELECT w.way_id, w.found FROM query_ids q JOIN fetched_ways w ON w.way_id = q.way_id'):
+                cached.add(way_id)
+                if found:
+                    result[way_id] = {}
+            for way_id, key, value in con.execute('SELECT t.way_id, t.key, t.value FROM query_ids q JOIN fetched_way_tags t ON t.way_id = q.way_id'):
+                result.setdefault(way_id, {})[key] = value
+            edges_unique = [edge for edge in edges_unique if edge not in cached]
+            ut.log('...{} ways in cache, {} to fetch'.format(len(cached), len(edges_unique)))
+
+        batches = [edges_unique[i:i + batch_size] for i in range(0, len(edges_unique), batch_size)]
+        wait = _rate_limiter(max_requests_per_second)
+        start_time = time()
+        curr_perc_int = 0
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = {executor.submit(_query_with_retry, backend, batch, wait, retries, retry_timeout): batch for batch in batches}
+            for size_processed, future in enumerate(as_completed(futures), 1):
+                ways = future.result()
+                result.update(ways)
+                if con is not None:
+                    con.executemany('INSERT OR REPLACE INTO fetched_ways VALUES (?, ?)', ((way_id, int(way_id in ways)) for way_id in futures[future]))
+                    con.executemany('INSERT OR REPLACE INTO fetched_way_tags VALUES (?, ?, ?)', 
+                                    ((way_id, key, value) for way_id, tags in ways.items() for key, value in tags.items()))
+                    con.commit()
+                curr_perc_int, _ = ut.progress_update(size_processed, len(batches), start_time, curr_perc_int, step_perc=20)
+        return _overpy_result(result) if as_overpy else result
+    finally:
+        if con is not None:
+            con.close()
+
+
+def generate_df_edges(osm_result, cols=['lanes', 'maxspeed']):
+    """ dataframe with osm_edge_id and the cols of each way, from getinfo_osm or an overpy result """
+    if not isinstance(osm_result, dict):
+        osm_result = {way.id: way.tags for way in osm_result.ways}
+    df_edges = pd.DataFrame({'osm_edge_id': np.fromiter(osm_result.keys(), dtype=np.int64, count=len(osm_result))})
+    for col in cols:
+        df_edges[col] = np.array([tags.get(col, np.nan) for tags in osm_result.values()], dtype=object).astype(np.float64)
+    return df_edges
 
 
 def get_way_tags_values(tree, way_id, tag_labels):
     """
-    this is very slow.
+    this is very slow, for many ways use build_osm_tag_cache and get_ways_tags_from_cache.
     e.g.
     from xml.etree import ElementTree as ET
     tree = ET.parse('/cloud/regis/taxi_simples/fortaleza.osm.xml')
@@ -54,46 +172,152 @@ def get_way_tags_values(tree, way_id, tag_labels):
     return result
 
 
-def add_features_from_osm(df, osm_id_label, osm_xml_file, tag_labels, default_values=None):
+def iter_osm_ways(osm_xml_file, tag_labels, way_ids=None, progress=None):
+    """
+    Stream the ways of an OSM xml file with iterparse, yielding (way_id, {tag_label: value}) for the
+    tags in tag_labels (all tags if None). Each element is cleared once read, so memory does not grow with the file.
+    If way_ids is given (a set), only these ways are yielded.
+    progress, if given, is called with the number of bytes read so far.
+    """
+    if tag_labels is not None:
+        tag_labels = set(tag_labels)
+    with open(osm_xml_file, 'rb') as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                continue
+            if elem.tag == 'way':
+                way_id = int(elem.get('id'))
+                if way_ids is None or way_id in way_ids:
+                    tags = {}
+                    for child in elem.iter('tag'):
+                        key = child.get('k')
+                        if (tag_labels is None or key in tag_labels) and child.get('v') is not None:
+                            tags[key] = child.get('v')
+                    yield way_id, tags
+            """ the element and all read siblings are released """
+            elem.clear()
+            root.clear()
+            if progress is not None:
+                progress(f.tell())
+
+
+def _osm_file_hash(osm_xml_file):
+    sha1 = hashlib.sha1()
+    with open(osm_xml_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def build_osm_tag_cache(osm_xml_file, tag_labels=None, cache_file=None):
+    """
+    Build once a SQLite file mapping way_id to the tags in tag_labels (all tags if None) of an OSM file,
+    by default osm_xml_file + '.tags.sqlite'. Later calls reuse it while it has the requested tags and the
+    source file is the same: if its size or modification time changed, its hash is compared to the stored one.
+    Returns the path of the cache file.
+        Example:
+            cache_file = build_osm_tag_cache('fortaleza.osm.xml', ['lanes', 'maxspeed'])
+            get_ways_tags_from_cache(cache_file, [191585228, 191585229], ['lanes', 'maxspeed'])
+    """
+    if cache_file is None:
+        cache_file = osm_xml_file + '.tags.sqlite'
+    stat = os.stat(osm_xml_file)
+    con = sqlite3.connect(cache_file)
+    try:
+        con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        meta = dict(con.execute('SELECT key, value FROM meta'))
+        cached_labels = json.loads(meta['tag_labels']) if 'tag_labels' in meta else []
+        has_labels = cached_labels is None or (tag_labels is not None and set(tag_labels) <= set(cached_labels))
+
+        file_hash = None
+        if 'hash' in meta and has_labels:
+            if meta['size'] == str(stat.st_size) and meta['mtime'] == str(stat.st_mtime_ns):
+                ut.log('...OSM tag cache {} is valid'.format(cache_file))
+                return cache_file
+            file_hash = _osm_file_hash(osm_xml_file)
+            if file_hash == meta['hash']:
+                ut.log('...OSM tag cache {} is valid, same file hash'.format(cache_file))
+                con.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('size', str(stat.st_size)), ('mtime', str(stat.st_mtime_ns))])
+                con.commit()
+                return cache_file
+
+        if file_hash is None:
+            file_hash = _osm_file_hash(osm_xml_file)
+        if 'hash' in meta and meta['hash'] == file_hash and tag_labels is not None and cached_labels is not None:
+            """ same file, keep the tags already cached"""
+            tag_labels = sorted(set(tag_labels) | set(cached_labels))
+
+        ut.log('Building OSM tag cache {}...'.format(cache_file))
+        start_time = time()
+        con.execute('DROP TABLE IF EXISTS way_tags')
+        con.execute('CREATE TABLE way_tags (way_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (way_id, key)) WITHOUT ROWID')
+        rows = ((way_id, key, value) for way_id, tags in iter_osm_ways(osm_xml_file, tag_labels) for key, value in tags.items())
+        con.executemany('INSERT OR REPLACE INTO way_tags VALUES (?, ?, ?)', rows)
+        con.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('hash', file_hash), ('size', str(stat.st_size)), ('mtime', str(stat.st_mtime_ns)),
+                                                                      ('tag_labels', json.dumps(None if tag_labels is None else sorted(tag_labels)))])
+        con.commit()
+        ut.log('...{} tags cached in {:.2f} seconds'.format(con.execute('SELECT COUNT(*) FROM way_tags').fetchone()[0], time() - start_time))
+        return cache_file
+    finally:
+        con.close()
+
+
+def get_ways_tags_from_cache(cache_file, way_ids, tag_labels):
+    """
+    Bulk lookup of the tags in tag_labels of way_ids in a cache built by build_osm_tag_cache.
+    Returns a dataframe with way_id, key and value, one row by tag found.
+    """
+    con = sqlite3.connect(cache_file)
+    try:
+        con.execute('CREATE TEMP TABLE query_ids (way_id INTEGER PRIMARY KEY)')
+        con.executemany('INSERT OR IGNORE INTO query_ids VALUES (?)', ((int(way_id),) for way_id in way_ids))
+        query = ('SELECT t.way_id, t.key, t.value FROM query_ids q JOIN way_tags t ON t.way_id = q.way_id '
+                 'WHERE t.key IN ({})'.format(','.join('?' * len(tag_labels))))
+        return pd.DataFrame(con.execute(query, list(tag_labels)).fetchall(), columns=['way_id', 'key', 'value'])
+    finally:
+        con.close()
+
+
+def add_features_from_osm(df, osm_id_label, osm_xml_file, tag_labels, default_values=None, use_cache=False, cache_file=None):
     """
     blazing fast and recommended!!!
+    The OSM file is streamed (see iter_osm_ways), so memory is bounded by the number of distinct
+    ways in df, not by the size of the file.
+    With use_cache=True the tags are read from a SQLite cache built once from the file (see build_osm_tag_cache),
+    so later runs on the same file do not parse it again.
     """
-    print('add_features_from_osm')
-    print('generating new dataframe from the original one...')
+    ut.log('add_features_from_osm')
+    ut.log('generating new dataframe from the original one...')
     filter_ = df[osm_id_label] >= 0
-    df_new = pd.DataFrame({osm_id_label : df.loc[filter_, osm_id_label].unique()})
-    
-    
-    for i, tag_label in enumerate(tag_labels):
-        if default_values is None:
-            df_new[tag_label] = np.nan
+    osm_ids = df.loc[filter_, osm_id_label].unique()
+    df_new = pd.DataFrame({osm_id_label : osm_ids})
+    defaults = {tag_label: np.nan if default_values is None else default_values[i] for i, tag_label in enumerate(tag_labels)}
+
+    if use_cache:
+        cache_file = build_osm_tag_cache(osm_xml_file, tag_labels, cache_file)
+        df_tags = get_ways_tags_from_cache(cache_file, osm_ids, tag_labels)
+    else:
+        ut.log('streaming xml file...')
+        size_all = os.path.getsize(osm_xml_file)
+        start_time = time()
+        progress = {'curr_perc_int': 0}
+        def update(size_processed):
+            progress['curr_perc_int'], _ = ut.progress_update(size_processed, max(size_all, 1), start_time, progress['curr_perc_int'], step_perc=20)
+
+        rows = [(way_id, key, value) for way_id, tags in iter_osm_ways(osm_xml_file, tag_labels, set(osm_ids), update) for key, value in tags.items()]
+        df_tags = pd.DataFrame(rows, columns=['way_id', 'key', 'value'])
+    ut.log('...{} of {} ways found'.format(df_tags['way_id'].nunique(), osm_ids.shape[0]))
+
+    """ one column array by tag, created only if the tag was found"""
+    position = pd.Index(osm_ids).get_indexer(df_tags['way_id'].values)
+    for tag_label in tag_labels:
+        found = (df_tags['key'] == tag_label).values
+        if found.any():
+            values = np.full(osm_ids.shape[0], defaults[tag_label], dtype=object)
+            values[position[found]] = df_tags['value'].values[found]
+            df_new[tag_label] = values
         else:
-            df_new[tag_label] = default_values[i]
-    
-    if df_new.index.name != osm_id_label:
-        df_new.set_index(osm_id_label, inplace=True)
-
-    print('loading xml file...')
-    tree = ET.parse(osm_xml_file)
-    print('finding way elements...')
-    tags = tree.findall(".//way")
-    size_all = len(tags)
-    size_processed = 0
-    osmEdgeId_values = df_new.index.values
-    start_time = time()
-    curr_perc_int = 0
-    for tag in tags:
-        way_id = int(tag.get('id'))
-        if way_id in osmEdgeId_values:
-            children_tags = tag.getchildren()
-            for ctag in children_tags:
-                if ctag.tag == 'tag':
-                    key = ctag.get('k')
-                    if key in tag_labels:
-                        df_new.at[way_id, key] = ctag.get('v')
-
-        size_processed += 1
-        curr_perc_int, _ = ut.progress_update(size_processed, size_all, start_time, curr_perc_int, step_perc=20)
-    
-    df_new.reset_index(inplace=True)
+            df_new[tag_label] = defaults[tag_label]
     return df_new
@@ -0,0 +1,183 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from pymove import utils as ut
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+""" temporary column with the position of each row in the original dataframe """
+ROW_LABEL = '__pymove_row'
+
+
+def _is_shareable(series):
+    """ only columns of numbers, booleans and naive datetimes can be in shared memory """
+    return isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufmM'
+
+def _column_values(series):
+    """ numpy array of a shareable column, otherwise the pandas array, which keeps categories and time zones """
+    return series.values if _is_shareable(series) else series.array
+
+def _to_shared(values):
+    """ copy an array to a new shared memory block, returns the block and its spec (name, dtype, shape) """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+    return shm, (shm.name, values.dtype.str, values.shape)
+
+def _from_shared(spec, rows=slice(None), unlink=False):
+    """ copy an array, or only its rows (a slice or positions), from a shared memory block """
+    name, dtype, shape = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        values = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        values = values[rows].copy() if isinstance(rows, slice) else values[rows]
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return values
+
+def _run_partition(func, kwargs, columns, order_spec, start, stop, return_frame):
+    """
+    Worker: build the dataframe of one partition from the shared columns, run func on it inplace
+    and put the resulting columns in new shared memory blocks, unlinked later by the parent process.
+    """
+    rows = _from_shared(order_spec, slice(start, stop))
+    data = {}
+    for label, shared, values in columns:
+        data[label] = _from_shared(values, rows) if shared else values
+    df_ = pd.DataFrame(data, columns=[label for label, _, _ in columns])
+    df_[ROW_LABEL] = rows
+
+    returned = func(df_, **kwargs)
+    if not return_frame:
+        return returned, None
+
+    result = []
+    for label in df_.columns:
+        if _is_shareable(df_[label]):
+            shm, spec = _to_shared(df_[label].values)
+            shm.close()
+            result.append((label, True, spec))
+        else:
+            result.append((label, False, df_[label].array))
+    return returned, result
+
+def _unlink_result(result):
+    """ free the shared memory blocks of a partition result that was not reassembled """
+    for _, shared, values in result:
+        if shared:
+            shm = shared_memory.SharedMemory(name=values[0])
+            shm.close()
+            shm.unlink()
+
+def _replace_inplace(df_, result):
+    """ replace rows and columns of df_ by the ones in result, whose rows are a subset of df_ in the same order """
+    if result.shape[0] < df_.shape[0]:
+        keep = np.zeros(df_.shape[0], dtype=np.bool_)
+        keep[result[ROW_LABEL].values] = True
+        df_.drop(index=df_.index[~keep], inplace=True)
+    df_.index = pd.RangeIndex(result.shape[0])
+
+    columns = [label for label in result.columns if label != ROW_LABEL]
+    df_.drop(columns=[label for label in df_.columns if label not in columns], inplace=True)
+    for label in columns:
+        df_[label] = _column_values(result[label])
+    for i, label in enumerate(columns):
+        if df_.columns[i] != label:
+            df_.insert(i, label, df_.pop(label))
+
+def apply_by_id(df_, func, label_id, kwargs={}, n_jobs=-1, n_partitions=None, sort_by=None, return_frame=True):
+    """
+    Run func(df_partition, **kwargs) inplace on hash partitions by id in a process pool.
+    Number, boolean and datetime columns pass through shared memory, other columns are pickled.
+    The resulting rows are reassembled in the order of df_ and replace its content inplace,
+    with a new RangeIndex. If sort_by is given, df_ is sorted by it before, as func would do.
+    With return_frame=False, func is only run for its return value (e.g. checks) and df_ is kept.
+        Example:
+            apply_by_id(df, trajutils.create_update_dist_features, 'id', {'sort': False}, n_jobs=8)
+    Returns a list with the values returned by func in each partition.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_partitions is None:
+        n_partitions = n_jobs * 4
+
+    if df_.index.name is not None:
+        ut.log('...Reset index')
+        df_.reset_index(inplace=True)
+    if sort_by is not None:
+        ut.log('...Sorting by {}'.format(sort_by))
+        df_.sort_values(sort_by, kind='mergesort', inplace=True)
+
+    if shared_memory is None:
+        ut.log('...shared memory needs python 3.8 or newer, running with n_jobs=1')
+        return [func(df_, **kwargs)]
+
+    ut.log('...Running {} on {} partitions with {} processes'.format(func.__name__, n_partitions, n_jobs))
+    start_time = time.time()
+    blocks = []
+    results = []
+    try:
+        """ rows of each partition are contiguous in order"""
+        partition = pd.util.hash_pandas_object(df_[label_id], index=False).values % np.uint64(n_partitions)
+        order = np.argsort(partition, kind='stable')
+        bounds = np.searchsorted(partition[order], np.arange(n_partitions + 1))
+        shm, order_spec = _to_shared(order)
+        blocks.append(shm)
+
+        shared_columns = {}
+        for label in df_.columns:
+            if _is_shareable(df_[label]):
+                shm, spec = _to_shared(df_[label].values)
+                blocks.append(shm)
+                shared_columns[label] = spec
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = []
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                if stop == start:
+                    continue
+                columns = []
+                for label in df_.columns:
+                    if label in shared_columns:
+                        columns.append((label, True, shared_columns[label]))
+                    else:
+                        columns.append((label, False, _column_values(df_[label])[order[start:stop]]))
+                futures.append(executor.submit(_run_partition, func, kwargs, columns, order_spec, start, stop, return_frame))
+            for future in futures:
+                results.append(future.result())
+    except Exception as e:
+        for _, result in results:
+            if result is not None:
+                _unlink_result(result)
+        raise e
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    if return_frame and len(results) > 0:
+        """ reassemble the partitions in the original order"""
+        data = {}
+        labels = [label for label, _, _ in results[0][1]]
+        for i, label in enumerate(labels):
+            parts = []
+            for _, result in results:
+                _, shared, values = result[i]
+                parts.append(_from_shared(values, unlink=True) if shared else values)
+            if all(isinstance(values, np.ndarray) for values in parts):
+                data[label] = np.concatenate(parts)
+            else:
+                data[label] = pd.concat([pd.Series(values) for values in parts], ignore_index=True).array
+        result = pd.DataFrame(data, columns=labels)
+        result = result.iloc[np.argsort(result[ROW_LABEL].values, kind='stable')]
+        _replace_inplace(df_, result)
+
+    ut.log('...Parallel time: {:.3f} seconds'.format(time.time() - start_time))
+    return [returned for returned, _ in results]
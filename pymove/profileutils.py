@@ -0,0 +1,200 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+""" profilers running now, innermost last; profile() and the patched functions record into all of them """
+_active = []
+
+PROFILE_COLUMNS = ['step', 'depth', 'start', 'wall_time', 'rows_in', 'rows_out', 'mem_before', 'mem_after', 'mem_delta', 'mem_peak']
+
+
+def _rows(obj):
+    """ number of rows of a dataframe, TrajectoryFrame or array, None for other objects """
+    shape = getattr(obj, 'shape', None)
+    if isinstance(shape, tuple) and len(shape) > 0:
+        return int(shape[0])
+    return None
+
+def _default_modules():
+    from pymove import trajutils, gridutils, osmutils
+    return [trajutils, gridutils, osmutils]
+
+def _public_functions(module):
+    """ public functions defined in module, except generators, whose work happens after they return """
+    for name, obj in list(vars(module).items()):
+        if inspect.isfunction(obj) and obj.__module__ == module.__name__ and not name.startswith('_') \
+                and not inspect.isgeneratorfunction(obj):
+            yield name, obj
+
+
+class Profiler(object):
+    """
+    Record the wall time, rows in and out and memory of each call to the public functions of modules
+    (trajutils, gridutils and osmutils by default) and of each step block, while the profiler is active.
+    Memory is in MB: by memory='rss', the resident memory of the process, with the peak sampled every
+    interval seconds, or by memory='tracemalloc', the memory allocated by python, numpy and pandas,
+    exact but slower to run. mem_peak is the peak during the step above mem_before.
+    Nested calls are recorded too, with their depth.
+        Example:
+            with profileutils.Profiler() as profiler:
+                trajutils.create_update_dist_time_speed_features(df)
+                with profiler.step('filter speed', df) as record:
+                    df = df[df.speed_to_prev < 50]
+                    record['rows_out'] = df.shape[0]
+            profiler.to_dataframe()
+            profiler.to_json('profile.json')
+    """
+    def __init__(self, modules=None, memory='rss', interval=0.01):
+        if memory == 'rss' and psutil is None:
+            raise ImportError("memory='rss' needs psutil, use memory='tracemalloc'")
+        if memory not in ['rss', 'tracemalloc']:
+            raise ValueError("memory must be 'rss' or 'tracemalloc', not {}".format(memory))
+        self.modules = modules
+        self.memory = memory
+        self.interval = interval
+        self.records = []
+        self._open = []
+        self._patched = []
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def _memory(self):
+        """ current memory in bytes, and the peak since the last call for tracemalloc """
+        if self.memory == 'tracemalloc':
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            return current, peak
+        rss = psutil.Process(os.getpid()).memory_info().rss
+        return rss, rss
+
+    def _update_peaks(self, peak):
+        for record in self._open:
+            record['_peak'] = max(record['_peak'], peak)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            if len(self._open) > 0:
+                self._update_peaks(self._memory()[1])
+
+    @contextmanager
+    def step(self, name, df_=None):
+        """ record a block of code as a step; rows_in and rows_out are the rows of df_ before and after it """
+        current, peak = self._memory()
+        self._update_peaks(peak)
+        record = {'step': name, 'depth': len(self._open), 'start': time.time(), 'rows_in': _rows(df_),
+                  'rows_out': None, '_before': current, '_peak': current}
+        self._open.append(record)
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - start_time
+            current, peak = self._memory()
+            self._update_peaks(max(current, peak))
+            self._open.remove(record)
+            if record['rows_out'] is None:
+                record['rows_out'] = _rows(df_)
+            record['mem_before'] = record.pop('_before') / 1024**2
+            record['mem_after'] = current / 1024**2
+            record['mem_delta'] = record['mem_after'] - record['mem_before']
+            record['mem_peak'] = record.pop('_peak') / 1024**2 - record['mem_before']
+            self.records.append(record)
+
+    def _wrap(self, func):
+        name = '{}.{}'.format(func.__module__.split('.')[-1], func.__name__)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            df_ = args[0] if len(args) > 0 else None
+            with self.step(name, df_) as record:
+                result = func(*args, **kwargs)
+                if _rows(result) is not None:
+                    record['rows_out'] = _rows(result)
+                return result
+        return wrapper
+
+    def __enter__(self):
+        if self.memory == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        for module in (self.modules if self.modules is not None else _default_modules()):
+            for name, func in _public_functions(module):
+                setattr(module, name, self._wrap(func))
+                self._patched.append((module, name, func))
+        if self.memory == 'rss':
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.remove(self)
+        for module, name, func in reversed(self._patched):
+            setattr(module, name, func)
+        self._patched = []
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        if getattr(self, '_started_tracemalloc', False):
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        return False
+
+    def to_dataframe(self):
+        """ one row per recorded step, in the order they finished """
+        return pd.DataFrame(self.records, columns=PROFILE_COLUMNS)
+
+    def to_json(self, filename=None):
+        """ the records as a JSON list, written to filename when given """
+        records = json.dumps(self.records, indent=1)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(records)
+        return records
+
+
+def profile(func=None, name=None):
+    """
+    Decorator recording each call of func as a step in the active profilers, and doing nothing else without one.
+        Example:
+            @profileutils.profile
+            def my_step(df_): ...
+    """
+    if func is None:
+        return functools.partial(profile, name=name)
+    label = name if name is not None else func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if len(_active) == 0:
+            return func(*args, **kwargs)
+        df_ = args[0] if len(args) > 0 else None
+        with _step_in_all(list(_active), label, df_) as records:
+            result = func(*args, **kwargs)
+            if _rows(result) is not None:
+                for record in records:
+                    record['rows_out'] = _rows(result)
+            return result
+    return wrapper
+
+@contextmanager
+def _step_in_all(profilers, name, df_):
+    """ the same step open in several profilers """
+    if len(profilers) == 0:
+        yield []
+        return
+    with profilers[0].step(name, df_) as record:
+        with _step_in_all(profilers[1:], name, df_) as records:
+            yield [record] + records
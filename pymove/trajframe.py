@@ -0,0 +1,164 @@
+import time
+import numpy as np
+import pandas as pd
+from pymove import trajutils
+from pymove import utils as ut
+
+
+def _is_sorted_by_id_datetime(ids, times):
+    """ True when the points of each id are contiguous and in ascending datetime """
+    if ids.shape[0] < 2:
+        return True
+    change = ids[1:] != ids[:-1]
+    if np.count_nonzero(change) + 1 != pd.unique(ids).shape[0]:
+        return False
+    return bool(np.all(change | (times[1:] >= times[:-1])))
+
+def _offsets(ids):
+    """ start of each run of equal ids, plus the number of points at the end """
+    starts = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    return np.concatenate([[0], starts, [ids.shape[0]]]).astype(np.int64) if ids.shape[0] > 0 else np.zeros(1, dtype=np.int64)
+
+
+def _same_array(values, other):
+    """ True when values and other are views of the same memory, with the same shape and dtype """
+    return values.__array_interface__['data'][0] == other.__array_interface__['data'][0] and values.shape == other.shape \
+        and values.strides == other.strides and values.dtype == other.dtype
+
+
+class TrajectoryFrame(object):
+    """
+    Points sorted by id and datetime in a dataframe with a RangeIndex, plus the offsets of each id:
+    the points of ids[i] are the rows offsets[i] to offsets[i + 1] - 1.
+    trajutils functions accept it in place of a dataframe, then they skip the sort and index resets,
+    and the id boundaries come from offsets.
+        Example:
+            tf = TrajectoryFrame(df)
+            trajutils.create_update_dist_time_speed_features(tf)
+            trajutils.clean_gps_speed_max_radius(tf, speed_max=50)
+            trajutils.segment_traj_by_max_time(tf)
+            df = tf.to_dataframe()
+    df_ is wrapped without copy (it is sorted inplace when needed) unless copy=True.
+    """
+    def __init__(self, df_, label_id=None, dic_labels=None, copy=False):
+        if dic_labels is None:
+            dic_labels = trajutils.dic_labels
+        if label_id is None:
+            label_id = dic_labels['id']
+        self.label_id = label_id
+        self.dic_labels = dic_labels
+        self.df = df_.copy() if copy is True else df_
+        self.is_sorted = False
+        self._radians = None
+        self.sort()
+
+    @classmethod
+    def from_arrays(cls, ids, lat, lon, datetime, label_id=None, dic_labels=None, **columns):
+        """ build a TrajectoryFrame from numpy arrays, without copying them when they are already sorted """
+        if dic_labels is None:
+            dic_labels = trajutils.dic_labels
+        if label_id is None:
+            label_id = dic_labels['id']
+        data = {label_id: ids, dic_labels['lat']: lat, dic_labels['lon']: lon, dic_labels['datetime']: datetime}
+        data.update(columns)
+        return cls(pd.DataFrame(data, copy=False), label_id, dic_labels)
+
+    def sort(self):
+        """ sort by id and datetime, only if needed, and compute the offsets """
+        df_ = self.df
+        if df_.index.name is not None:
+            ut.log('...Reset index')
+            df_.reset_index(inplace=True)
+
+        ids = df_[self.label_id].values
+        times = df_[self.dic_labels['datetime']].values
+        if not _is_sorted_by_id_datetime(ids, times):
+            start_time = time.time()
+            ut.log('...Sorting by {} and {}'.format(self.label_id, self.dic_labels['datetime']))
+            df_.sort_values([self.label_id, self.dic_labels['datetime']], kind='mergesort', inplace=True)
+            ut.log('...Sorting time: {:.3f} seconds'.format(time.time() - start_time))
+        if not isinstance(df_.index, pd.RangeIndex) or df_.index.start != 0 or df_.index.step != 1:
+            df_.reset_index(drop=True, inplace=True)
+        if df_.columns[0] != self.label_id:
+            df_.insert(0, self.label_id, df_.pop(self.label_id))
+
+        self.is_sorted = True
+        self.refresh()
+
+    def refresh(self):
+        """ recompute ids and offsets after rows were dropped or the id column was replaced, keeping the order """
+        if self.df.index.name is not None or not isinstance(self.df.index, pd.RangeIndex):
+            self.df.reset_index(drop=True, inplace=True)
+        ids = self.df[self.label_id].values
+        self.offsets = _offsets(ids)
+        self.ids = ids[self.offsets[:-1]]
+        self._radians = None
+
+    def points_in_radians(self, dtype=np.float64):
+        """
+        (lat, lon, cos(lat)) in radians, as trajutils._points_in_radians, kept between calls of the distance
+        features and cleaning functions on this frame. The read only arrays are computed again when lat or lon
+        is replaced, dtype changes or refresh is called; call refresh after changing lat or lon inplace.
+        """
+        lat, lon = self.lat, self.lon
+        if self._radians is not None:
+            (cached_lat, cached_lon, cached_dtype), points = self._radians
+            if cached_dtype == np.dtype(dtype) and _same_array(lat, cached_lat) and _same_array(lon, cached_lon):
+                return points
+        points = trajutils._points_in_radians(lat, lon, dtype)
+        for values in points:
+            values.flags.writeable = False
+        """ the source arrays are kept, so their memory is not reused by other arrays while cached """
+        self._radians = ((lat, lon, np.dtype(dtype)), points)
+        return points
+
+    def bounds(self):
+        """ (order, first, last) as trajutils._group_bounds, without factorizing the ids """
+        size = self.offsets[-1]
+        first = np.zeros(size, dtype=np.bool_)
+        last = np.zeros(size, dtype=np.bool_)
+        first[self.offsets[:-1]] = True
+        last[self.offsets[1:] - 1] = True
+        return None, first, last
+
+    def lengths(self):
+        """ number of points of each id """
+        return np.diff(self.offsets)
+
+    def point_ids(self):
+        """ position in ids of each point """
+        return np.repeat(np.arange(self.ids.shape[0]), self.lengths())
+
+    def trajectory(self, id_):
+        """ points of one id, as a view of df """
+        i = np.flatnonzero(self.ids == id_)
+        if i.shape[0] == 0:
+            raise KeyError(id_)
+        return self.df.iloc[self.offsets[i[0]]:self.offsets[i[0] + 1]]
+
+    @property
+    def lat(self):
+        return self.df[self.dic_labels['lat']].values
+
+    @property
+    def lon(self):
+        return self.df[self.dic_labels['lon']].values
+
+    @property
+    def time(self):
+        """ datetime as int64 nanoseconds """
+        return self.df[self.dic_labels['datetime']].values.view(np.int64)
+
+    @property
+    def shape(self):
+        return self.df.shape
+
+    def __len__(self):
+        return self.df.shape[0]
+
+    def __repr__(self):
+        return 'TrajectoryFrame: {} points, {} ids by {}\n{}'.format(self.df.shape[0], self.ids.shape[0], self.label_id, repr(self.df))
+
+    def to_dataframe(self, copy=False):
+        """ the sorted dataframe, shared with the TrajectoryFrame unless copy=True """
+        return self.df.copy() if copy is True else self.df
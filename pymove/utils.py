@@ -6,12 +6,90 @@ import math
 
 #import timeutils
 import datetime
+import logging
+import sys
 import time
 from pandas._libs.tslibs.timestamps import Timestamp
-from ipywidgets import IntProgress, HTML, VBox
-from IPython.display import display
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """ StreamHandler to the current sys.stdout, which notebooks and redirect_stdout replace after import """
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+""" 
+logger of the messages and progress of pymove. By default INFO messages go to stdout as plain prints, 
+use set_verbosity to change it, or configure the 'pymove' logger as any other logging logger.
+"""
+logger = logging.getLogger('pymove')
+if len(logger.handlers) == 0:
+    _handler = _StdoutHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+""" progress messages of progress_update are at least interval seconds apart, callback (if any) receives them """
+dic_progress = {'interval': 1.0, 'callback': None}
+
+""" time of the last progress message of each reporter running, by its start_time """
+_progress_last_time = {}
+
+def set_verbosity(level=logging.INFO, progress_interval=None, progress_callback=None):
+    """
+    Set the level of the pymove messages: logging.INFO (or 'INFO') shows all of them, logging.WARNING (or 'WARNING', 'quiet')
+    only warnings and errors, for batch runs. progress_interval is the minimum time in seconds between progress messages,
+    and progress_callback a function called instead of them with (size_processed, size_all, elapsed seconds).
+        Example:
+            set_verbosity('quiet')
+    """
+    if isinstance(level, str):
+        level = logging.WARNING if level.lower() == 'quiet' else logging.getLevelName(level.upper())
+    logger.setLevel(level)
+    if progress_interval is not None:
+        dic_progress['interval'] = progress_interval
+    dic_progress['callback'] = progress_callback
+
+def log(*args, sep=' ', end='\n', level=logging.INFO):
+    """ same as print, to the pymove logger, doing nothing when its level is above level """
+    if logger.isEnabledFor(level):
+        message = sep.join(str(arg) for arg in args) + end
+        logger.log(level, message[:-1] if message.endswith('\n') else message)
 
 def log_progress(sequence, every=None, size=None, name='Items'):
+    """ 
+    Yield the items of sequence showing a progress bar in notebooks with ipywidgets, 
+    otherwise progress messages by progress_update 
+    """
+    try:
+        from ipywidgets import IntProgress, HTML, VBox
+        from IPython.display import display
+    except ImportError:
+        if size is None:
+            try:
+                size = len(sequence)
+            except TypeError:
+                """ iterator without size, only the count and time are shown """
+                pass
+        curr_perc_int = -1
+        start_time = time.time()
+        last_time = start_time
+        index = 0
+        for index, record in enumerate(sequence, 1):
+            if size is not None:
+                curr_perc_int, _ = progress_update(index, size, start_time, curr_perc_int)
+            elif time.time() - last_time >= dic_progress['interval']:
+                last_time = time.time()
+                log('{}: {} / ? in {}'.format(name, index, deltatime_str(last_time - start_time)))
+            yield record
+        if size is None:
+            log('{}: {} in {}'.format(name, index, deltatime_str(time.time() - start_time)))
+        return
 
     is_iterator = False
     if size is None:
@@ -82,16 +160,30 @@ def progress_update(size_processed, size_all, start_time, curr_perc_int, step_pe
     e.g.
     curr_perc_int, _ = pu.progress_update(size_processed, size_all, start_time, curr_perc_int)
     returns: curr_perc_int_new, deltatime_str
+    Messages are at most one per dic_progress['interval'] seconds for each reporter (told apart by their start_time),
+    besides 100%, and skipped when the verbosity is above INFO.
     """
     curr_perc_new = size_processed*100.0 / size_all
     curr_perc_int_new = int(curr_perc_new)
     if curr_perc_int_new != curr_perc_int and curr_perc_int_new % step_perc == 0:
-        deltatime = time.time() - start_time
+        now = time.time()
+        if curr_perc_int_new < 100:
+            if now - _progress_last_time.get(start_time, 0.0) < dic_progress['interval']:
+                return curr_perc_int_new, None
+            _progress_last_time[start_time] = now
+        else:
+            _progress_last_time.pop(start_time, None)
+        deltatime = now - start_time
+        if dic_progress['callback'] is not None:
+            dic_progress['callback'](size_processed, size_all, deltatime)
+            return curr_perc_int_new, None
+        if not logger.isEnabledFor(logging.INFO):
+            return curr_perc_int_new, None
         deltatime_str_ = deltatime_str(deltatime)
         est_end = deltatime / curr_perc_new * 100
         est_time_str = deltatime_str(est_end - deltatime)
-        print('({}/{}) {}% in {} - estimated end in {}'.format(size_processed, size_all, curr_perc_int_new, deltatime_str_, est_time_str))
-        return curr_perc_int_new, deltatime_str
+        log('({}/{}) {}% in {} - estimated end in {}'.format(size_processed, size_all, curr_perc_int_new, deltatime_str_, est_time_str))
+        return curr_perc_int_new, deltatime_str_
     else:
         return curr_perc_int_new, None
 
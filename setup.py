@@ -9,7 +9,7 @@ try:
 except Exception as e:
     raise e
   
-DEPENDENCIES = ['tqdm','numpy', 'pandas', 'scipy', 'geojson', 'matplotlib', 'shapely', 'folium', 'mplleaflet', 'psutil', 'ipywidgets']  
+DEPENDENCIES = ['tqdm','numpy', 'pandas', 'scipy', 'geojson', 'matplotlib', 'shapely', 'folium', 'mplleaflet', 'psutil']  
 
 setup(
      name="pymove",  
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from pymove import trajutils
+
+
+def _frame():
+    return pd.DataFrame({'datetime': pd.to_datetime(['2019-04-28 02:00:56', '2019-04-29 08:00:56', None,
+                                                     '2019-05-01 14:00:56', '2019-05-04 20:00:56'])})
+
+def test_calendar_features_match_datetime_accessors():
+    df_ = _frame()
+    trajutils.create_update_calendar_features(df_)
+    datetime = df_['datetime']
+    assert df_['hour'].tolist()[:2] == [2, 8] and df_['hour'].isna().tolist() == datetime.isna().tolist()
+    assert df_['date'].equals(datetime.dt.normalize().rename('date'))
+    assert df_['day'].astype(object).equals(datetime.dt.day_name().rename('day'))
+    assert df_['period'].tolist() == ['early morning', 'morning', 'undefined', 'afternoon', 'evening']
+    assert df_['weekend'].tolist() == [1, 0, 0, 0, 1]
+    assert np.isnan(df_['hour_sin'][2]) and np.isclose(df_['hour_sin'][0], np.sin(2 * np.pi * 2 / 23.0))
+
+def test_weekend_recomputes_existing_day():
+    df_ = _frame()
+    df_['day'] = 'stale'
+    trajutils.create_update_weekend_features(df_)
+    assert df_['day'].astype(object).tolist()[:2] == ['Sunday', 'Monday']
+
+def test_weekend_does_not_create_day():
+    df_ = _frame()
+    trajutils.create_update_weekend_features(df_)
+    assert 'day' not in df_
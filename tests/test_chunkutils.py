@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import chunkutils
+
+
+def _frame(tz=None):
+    return pd.DataFrame({'id': [1, 1, 2, 2],
+                         'lat': [-3.80, -3.81, -3.82, -3.83],
+                         'lon': [-38.50, -38.51, -38.52, -38.53],
+                         'datetime': pd.date_range('2019-01-01 08:00', periods=4, freq='H', tz=tz)})
+
+
+@pytest.mark.parametrize('extension', ['parquet', 'csv'])
+def test_read_trajectories_naive_bounds_in_column_timezone(tmp_path, extension):
+    filename = str(tmp_path / 'points.{}'.format(extension))
+    df = _frame('America/Fortaleza')
+    df.to_parquet(filename) if extension == 'parquet' else df.to_csv(filename, index=False)
+    df_ = chunkutils.read_trajectories(filename, start_datetime='2019-01-01 09:00', end_datetime='2019-01-01 10:00')
+    assert df_['datetime'].dt.hour.tolist() == [9, 10]
+    df_ = chunkutils.read_trajectories(filename, start_datetime=pd.Timestamp('2019-01-01 12:00', tz='UTC'))
+    assert df_['datetime'].dt.hour.tolist() == [9, 10, 11]
+
+
+def test_read_trajectories_aware_bounds_need_aware_datetimes(tmp_path):
+    filename = str(tmp_path / 'points.parquet')
+    _frame().to_parquet(filename)
+    with pytest.raises(ValueError):
+        chunkutils.read_trajectories(filename, start_datetime=pd.Timestamp('2019-01-01 09:00', tz='UTC'))
+
+
+def _partition_columns(df_):
+    """ in the first partition a float column with NaN, in the second an int one and more categories than int8 holds """
+    if df_['id'].iloc[0] == 1:
+        df_['value'] = np.where(df_['lat'] > -3.805, np.nan, 1.0)
+        df_['name'] = pd.Categorical(['a', 'b'])
+    else:
+        df_['value'] = np.arange(df_.shape[0])
+        df_['name'] = pd.Categorical(['c', 'd'], categories=[str(i) for i in range(300)] + ['c', 'd'])
+
+
+def test_process_by_chunks_parquet_partitions_with_other_dtypes(tmp_path):
+    input_file = str(tmp_path / 'points.csv')
+    output_file = str(tmp_path / 'out.parquet')
+    _frame().to_csv(input_file, index=False)
+    assert chunkutils.process_by_chunks(input_file, output_file, [_partition_columns], chunksize=2) == (4, 4)
+    df_ = pd.read_parquet(output_file)
+    assert df_['id'].tolist() == [1, 1, 2, 2]
+    assert df_['value'].fillna(-1).tolist() == [-1, 1, 0, 1]
+    assert df_['name'].astype(str).tolist() == ['a', 'b', 'c', 'd']
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import gridutils, trajutils
+
+
+BBOX = (-3.9, -38.6, -3.7, -38.4)
+
+
+def test_lazy_polygons_match_all_cells():
+    dic_grid = gridutils.create_virtual_grid(500, BBOX)
+    gridutils.create_all_polygons_on_grid(dic_grid)
+    lazy = dic_grid['grid_polygon']
+    gridutils.create_all_polygons_on_grid(dic_grid, all_cells=True)
+    polygons = dic_grid['grid_polygon']
+    assert lazy.shape == polygons.shape
+    for index_grid_lat, index_grid_lon in [(0, 0), (3, 7), (-1, -1), (polygons.shape[0] - 1, 0)]:
+        assert lazy[index_grid_lat][index_grid_lon].equals_exact(polygons[index_grid_lat][index_grid_lon], 0)
+        assert lazy[index_grid_lat, index_grid_lon].equals_exact(polygons[index_grid_lat, index_grid_lon], 0)
+    with pytest.raises(IndexError):
+        lazy[polygons.shape[0]][0]
+
+
+def test_index_grid_feature_matches_point_to_index_grid():
+    dic_grid = gridutils.create_virtual_grid(100, BBOX)
+    lat = np.array([-3.9, -3.85, -3.7000001, -3.95])
+    lon = np.array([-38.6, -38.45, -38.4000001, -38.5])
+    df = pd.DataFrame({'id': [1, 1, 2, 2], 'lat': lat, 'lon': lon, 'datetime': pd.date_range('2019-01-01', periods=4)})
+    trajutils.create_update_index_grid_feature(df, dic_grid, label_dtype=np.int32)
+    index_lat, index_lon = gridutils.point_to_index_grid(lat, lon, dic_grid)
+    assert df['index_grid_lat'].dtype == np.int32
+    assert df['index_grid_lat'].tolist() == index_lat.tolist()
+    assert df['index_grid_lon'].tolist() == index_lon.tolist()
+
+
+def _points(size=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'id': rng.integers(0, 20, size), 'lat': rng.uniform(-3.9, -3.7, size),
+                         'lon': rng.uniform(-38.6, -38.4, size), 'speed_to_prev': rng.exponential(5, size),
+                         'time_to_prev': rng.exponential(60, size)})
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_read_grid_round_trip(tmp_path, mmap):
+    dic_grid = gridutils.create_virtual_grid(500, BBOX)
+    aggregates = gridutils.aggregate_by_cell(_points(), dic_grid)
+    aggregates['weight'] = np.linspace(0, 1, aggregates.shape[0], dtype=np.float32)
+    filename = str(tmp_path / 'grid.pmg')
+    gridutils.save_grid(filename, dic_grid, aggregates)
+    saved = gridutils.read_grid(filename, mmap=mmap)
+    for label in gridutils.GRID_PARAMETERS:
+        assert saved[label] == dic_grid[label]
+    assert list(saved['aggregates']) == list(aggregates.columns)
+    for label in aggregates:
+        values = saved['aggregates'][label]
+        assert isinstance(values, np.memmap) == mmap
+        assert values.dtype == aggregates[label].dtype
+        np.testing.assert_array_equal(values, aggregates[label].values)
+
+    gridutils.save_grid(filename, dic_grid, {'count': np.zeros(0, dtype=np.int64)})
+    assert gridutils.read_grid(filename, mmap=mmap)['aggregates']['count'].shape == (0,)
+    gridutils.save_grid(filename, dic_grid)
+    assert gridutils.read_grid(filename, mmap=mmap)['aggregates'] == {}
+
+
+def test_save_grid_rejects_non_numeric_aggregates(tmp_path):
+    dic_grid = gridutils.create_virtual_grid(500, BBOX)
+    with pytest.raises(ValueError):
+        gridutils.save_grid(str(tmp_path / 'grid.pmg'), dic_grid, {'name': np.array(['a', 'b'], dtype=object)})
+    with open(str(tmp_path / 'other.pmg'), 'wb') as f:
+        f.write(b'not a grid')
+    with pytest.raises(ValueError):
+        gridutils.read_grid(str(tmp_path / 'other.pmg'))
+
+
+def test_save_read_grid_pkl_round_trip(tmp_path):
+    dic_grid = gridutils.create_virtual_grid(500, BBOX)
+    filename = str(tmp_path / 'grid.pkl')
+    gridutils.save_grid_pkl(filename, dic_grid)
+    assert gridutils.read_grid_pkl(filename) == dic_grid
+
+
+@pytest.mark.parametrize('max_points, max_depth', [(20, 16), (50, 3), (1000, 8)])
+def test_quadtree_leaves_contain_their_points(max_points, max_depth):
+    df = _points(size=2000, seed=1)
+    df.loc[:299, ['lat', 'lon']] = df.loc[:299, ['lat', 'lon']] * 0.001 + [-3.8 * 0.999, -38.5 * 0.999]
+    dic_quadtree = gridutils.create_quadtree_grid(df, max_points=max_points, max_depth=max_depth)
+    leaf = gridutils.point_to_quadtree_leaf(df['lat'].values, df['lon'].values, dic_quadtree)
+    leaves = gridutils.quadtree_leaf_bbox(dic_quadtree)
+
+    assert (leaf >= 0).all()
+    bbox = leaves.iloc[leaf]
+    assert (bbox['lat_min'].values <= df['lat'].values).all() and (df['lat'].values < bbox['lat_max'].values).all()
+    assert (bbox['lon_min'].values <= df['lon'].values).all() and (df['lon'].values < bbox['lon_max'].values).all()
+    assert np.bincount(leaf, minlength=leaves.shape[0]).tolist() == leaves['count'].tolist()
+    assert ((leaves['count'] <= max_points) | (leaves['depth'] == max_depth)).all()
+    assert np.isclose(((leaves['lat_max'] - leaves['lat_min']) ** 2).sum(), dic_quadtree['cell_size_by_degree'] ** 2)
+
+    levels = gridutils.aggregate_quadtree(dic_quadtree)
+    assert (levels.groupby('level')['value'].sum() == df.shape[0]).all()
+    assert levels.loc[levels['level'] == 0, 'value'].tolist() == [df.shape[0]]
+    assert gridutils.point_to_quadtree_leaf(np.array([-4.5]), np.array([-38.5]), dic_quadtree).tolist() == [-1]
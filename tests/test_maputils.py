@@ -0,0 +1,50 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import maputils
+
+
+def _frame(dtype=np.float64):
+    return pd.DataFrame({'id': ['a', 'b', 'a', np.nan, 'b'],
+                         'lat': np.array([-3.8162973, -3.7, -3.81, -3.9, -3.71], dtype=dtype),
+                         'lon': np.array([-38.5, -38.4, -38.51, -38.6, -38.41], dtype=dtype)})
+
+def test_save_wkt_keeps_float32_precision(tmp_path):
+    filename = str(tmp_path / 'traj.wkt')
+    maputils.save_wkt(_frame(np.float32), filename, 'id')
+    assert open(filename).read().splitlines() == ['id;linestring',
+                                                  'a;LINESTRING(-38.5 -3.8162973,-38.51 -3.81)',
+                                                  'b;LINESTRING(-38.4 -3.7,-38.41 -3.71)']
+
+def test_save_wkt_float64(tmp_path):
+    filename = str(tmp_path / 'traj.wkt')
+    maputils.save_wkt(_frame(), filename, 'id')
+    assert open(filename).read().splitlines()[1] == 'a;LINESTRING(-38.5 -3.8162973,-38.51 -3.81)'
+
+def test_save_geojson_float32_and_nan_ids(tmp_path):
+    filename = str(tmp_path / 'traj.geojson')
+    maputils.save_geojson(_frame(np.float32), filename, 'id')
+    text = open(filename).read()
+    assert '-3.8162973]' in text and '-3.8162972' not in text
+    features = json.loads(text)['features']
+    assert [feature['properties']['id'] for feature in features] == ['a', 'b']
+    assert features[0]['geometry']['coordinates'] == [[-38.5, -3.8162973], [-38.51, -3.81]]
+
+
+@pytest.mark.parametrize('time_bucket', [None, 'hour'])
+def test_heatmap_cells_leaves_out_missing_points(time_bucket):
+    df = pd.DataFrame({'lat': [-3.8, -3.8, np.nan, -3.8, np.inf],
+                       'lon': [-38.5, -38.5, -38.5, np.nan, -38.5],
+                       'datetime': pd.to_datetime(['2019-01-01 10:00', '2019-01-01 10:05', '2019-01-01 10:10',
+                                                   '2019-01-01 10:15', None])})
+    cells = maputils.heatmap_cells(df, time_bucket=time_bucket)
+    assert cells['count'].tolist() == [2]
+    assert np.isfinite(cells[['lat', 'lon']].values).all()
+    if time_bucket is not None:
+        assert cells['bucket'].tolist() == [10]
+
+
+def test_heatmap_cells_without_valid_points():
+    df = pd.DataFrame({'lat': [np.nan], 'lon': [np.nan], 'datetime': pd.to_datetime([None])})
+    assert maputils.heatmap_cells(df, time_bucket='hour').shape[0] == 0
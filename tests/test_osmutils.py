@@ -0,0 +1,91 @@
+import os
+import numpy as np
+from pymove import osmutils
+
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <way id="10"><nd ref="1"/><tag k="lanes" v="2"/><tag k="maxspeed" v="60"/></way>
+ <way id="20"><nd ref="2"/><tag k="lanes" v="{}"/></way>
+</osm>
+"""
+
+
+def _write_osm(path, lanes='3'):
+    path.write_text(OSM_XML.format(lanes))
+    return str(path)
+
+
+def _backend(calls):
+    def query(way_ids):
+        calls.append(list(way_ids))
+        return {way_id: {'lanes': '1'} for way_id in way_ids if way_id != 30}
+    return query
+
+
+def test_getinfo_osm_cache_shares_file_with_tag_cache(tmp_path):
+    osm_file = _write_osm(tmp_path / 'map.osm')
+    cache_file = str(tmp_path / 'cache.sqlite')
+    osmutils.build_osm_tag_cache(osm_file, None, cache_file)
+
+    calls = []
+    ways = osmutils.getinfo_osm(np.array([10, 30, 10]), backend=_backend(calls), max_requests_per_second=1000, cache_file=cache_file)
+    assert ways == {10: {'lanes': '1'}}
+    assert osmutils.get_ways_tags_from_cache(cache_file, [10, 20], ['lanes'])['value'].tolist() == ['2', '3']
+
+    """ rebuilding the tag cache keeps the ways fetched by getinfo_osm """
+    _write_osm(tmp_path / 'map.osm', lanes='4')
+    osmutils.build_osm_tag_cache(osm_file, None, cache_file)
+    assert osmutils.get_ways_tags_from_cache(cache_file, [20], ['lanes'])['value'].tolist() == ['4']
+    assert osmutils.getinfo_osm([10, 30], backend=_backend(calls), cache_file=cache_file) == ways
+    assert calls == [[10, 30]]
+
+
+def test_getinfo_osm_as_overpy():
+    result = osmutils.getinfo_osm([10, 30], backend=_backend([]), max_requests_per_second=1000, as_overpy=True)
+    assert [(way.id, way.tags) for way in result.ways] == [(10, {'lanes': '1'})]
+    df_edges = osmutils.generate_df_edges(result, cols=['lanes'])
+    assert df_edges.values.tolist() == [[10, 1.0]]
+
+
+def test_tag_cache_invalidation(tmp_path, monkeypatch):
+    osm_file = _write_osm(tmp_path / 'map.osm.xml')
+    calls = {'hash': 0, 'build': 0}
+    file_hash, iter_osm_ways = osmutils._osm_file_hash, osmutils.iter_osm_ways
+    def counted_hash(osm_xml_file):
+        calls['hash'] += 1
+        return file_hash(osm_xml_file)
+    def counted_ways(*args, **kwargs):
+        calls['build'] += 1
+        return iter_osm_ways(*args, **kwargs)
+    monkeypatch.setattr(osmutils, '_osm_file_hash', counted_hash)
+    monkeypatch.setattr(osmutils, 'iter_osm_ways', counted_ways)
+
+    cache_file = osmutils.build_osm_tag_cache(osm_file, ['lanes'])
+    assert cache_file == osm_file + '.tags.sqlite'
+    assert calls == {'hash': 1, 'build': 1}
+
+    """ unchanged file, or a subset of the cached tags: no hash, no rebuild"""
+    osmutils.build_osm_tag_cache(osm_file, ['lanes'])
+    assert calls == {'hash': 1, 'build': 1}
+
+    """ touched file with the same content: hash compared, no rebuild"""
+    stat = os.stat(osm_file)
+    os.utime(osm_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    osmutils.build_osm_tag_cache(osm_file, ['lanes'])
+    osmutils.build_osm_tag_cache(osm_file, ['lanes'])
+    assert calls == {'hash': 2, 'build': 1}
+
+    """ new tags on the same file: rebuilt keeping the cached ones"""
+    osmutils.build_osm_tag_cache(osm_file, ['maxspeed'])
+    assert calls['build'] == 2
+    tags = osmutils.get_ways_tags_from_cache(cache_file, [10, 20], ['lanes', 'maxspeed'])
+    assert sorted(map(tuple, tags.values.tolist())) == [(10, 'lanes', '2'), (10, 'maxspeed', '60'), (20, 'lanes', '3')]
+
+    """ changed content: rebuilt with the new values and only the requested tags"""
+    _write_osm(tmp_path / 'map.osm.xml', lanes='4')
+    os.utime(osm_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    osmutils.build_osm_tag_cache(osm_file, ['lanes'])
+    assert calls['build'] == 3
+    tags = osmutils.get_ways_tags_from_cache(cache_file, [10, 20], ['lanes', 'maxspeed'])
+    assert sorted(map(tuple, tags.values.tolist())) == [(10, 'lanes', '2'), (20, 'lanes', '4')]
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import trajutils
+
+
+def _frame():
+    rng = np.random.default_rng(2)
+    size = 300
+    return pd.DataFrame({'id': np.repeat([1, 2, 3], size // 3),
+                         'lat': -3.8 + np.cumsum(rng.normal(0, 0.0005, size)),
+                         'lon': -38.5 + np.cumsum(rng.normal(0, 0.0005, size)),
+                         'datetime': pd.Timestamp('2019-01-01') + pd.to_timedelta(np.arange(size) * 30, unit='s')})
+
+
+def test_simplify_dp_without_datetime():
+    df = _frame()
+    expected = trajutils.simplify_traj(df, tolerance=20)
+    result = trajutils.simplify_traj(df.drop(columns='datetime'), tolerance=20)
+    assert 0 < result.shape[0] < df.shape[0]
+    pd.testing.assert_frame_equal(result, expected.drop(columns='datetime'))
+
+
+def test_simplify_sed_needs_datetime():
+    with pytest.raises(ValueError):
+        trajutils.simplify_traj(_frame().drop(columns='datetime'), method='sed')
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import trajutils
+
+
+def _frame(tz=None, n=5000):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'id': rng.integers(0, 20, n),
+                       'datetime': pd.to_datetime(rng.integers(-3 * 10**8, 10**9, n), unit='s')})
+    if tz is not None:
+        df['datetime'] = df['datetime'].dt.tz_localize('UTC').dt.tz_convert(tz)
+    return df
+
+@pytest.mark.parametrize('tz', [None, 'America/Fortaleza'])
+@pytest.mark.parametrize('str_format', ['%Y%m%d%H', '%Y-%m-%d %H:%M', '%Y%m%d', '%Y-%B', '%y%m', '%Y%j', 
+                                        '%Y%m%d %I%p', '%Y%m%d%H%M%S', '%a %Y-%m-%d', '%Y'])
+def test_int_tid_splits_as_str_tid(str_format, tz):
+    df_str = _frame(tz)
+    df_int = df_str.copy()
+    trajutils.create_update_tid_based_on_id_datatime(df_str, str_format=str_format)
+    dic_tid = trajutils.create_update_tid_based_on_id_datatime(df_int, str_format=str_format, encoding='int')
+    assert df_int['tid'].dtype == np.int64
+    assert (pd.factorize(df_int['tid'])[0] == pd.factorize(df_str['tid'])[0]).all()
+    assert (trajutils.tid_to_str(df_int['tid'], dic_tid) == df_str['tid'].values).all()
+
+@pytest.mark.parametrize('str_format', ['%B', '%m%H', '%Y%d', '%Y%m%d%I', '%Y%U', '%Y%m %a', '%H:%M', '%Y%m%d%Z'])
+def test_int_tid_rejects_formats_that_merge_buckets(str_format):
+    with pytest.raises(ValueError):
+        trajutils.create_update_tid_based_on_id_datatime(_frame(), str_format=str_format, encoding='int')
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from pymove import trajutils
+from pymove.trajframe import TrajectoryFrame
+
+
+def _frame():
+    rng = np.random.default_rng(1)
+    size = 200
+    return pd.DataFrame({'id': rng.integers(0, 5, size),
+                         'lat': -3.8 + rng.normal(0, 0.01, size),
+                         'lon': -38.5 + rng.normal(0, 0.01, size),
+                         'datetime': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 10**6, size), unit='s')})
+
+
+def test_points_in_radians_cached_until_lat_changes():
+    tf = TrajectoryFrame(_frame())
+    points = tf.points_in_radians()
+    assert tf.points_in_radians() is points
+    assert tf.points_in_radians(np.float32) is not points
+    tf.df['lat'] = tf.df['lat'] + 0.001
+    assert np.allclose(tf.points_in_radians()[0], np.radians(tf.lat))
+    tf.df.drop(index=[0, 1], inplace=True)
+    tf.refresh()
+    assert tf.points_in_radians()[0].shape[0] == tf.df.shape[0]
+
+
+def test_features_and_cleaning_same_with_trajectory_frame():
+    df = _frame()
+    tf = TrajectoryFrame(df.copy())
+    for df_ in [df, tf]:
+        trajutils.create_update_dist_time_speed_features(df_)
+        trajutils.clean_gps_speed_max_radius(df_, speed_max=1.0)
+        trajutils.create_update_dist_features(df_)
+    pd.testing.assert_frame_equal(df, tf.df)
@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymove import trajutils
+
+
+def _frame(n_ids=60, max_points=30, seed=0):
+    """ shuffled points of n_ids ids, with single point ids, jumps and repeated positions """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_ids):
+        size = 1 if i < 4 else int(rng.integers(2, max_points))
+        lat = -3.8 + np.cumsum(rng.normal(0, 0.001, size))
+        lon = -38.5 + np.cumsum(rng.normal(0, 0.001, size))
+        lat[rng.random(size) < 0.05] += 0.05
+        repeated = np.flatnonzero(rng.random(size) < 0.1)
+        repeated = repeated[repeated > 0]
+        lat[repeated], lon[repeated] = lat[repeated - 1], lon[repeated - 1]
+        start = pd.Timestamp('2019-04-28') + pd.Timedelta(seconds=int(rng.integers(0, 86400)))
+        frames.append(pd.DataFrame({'id': 'M{:03d}'.format(i), 'lat': lat, 'lon': lon,
+                                    'datetime': start + pd.to_timedelta(np.cumsum(rng.integers(1, 600, size)), unit='s')}))
+    return pd.concat(frames).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * 1000 * np.arcsin(np.sqrt(a))
+
+
+def _reference_features(df):
+    """ features of each id computed with groupby shifts, in the layout of the per-id loops they replaced """
+    df = df.sort_values(['id', 'datetime']).reset_index(drop=True)
+    group = df.groupby('id')
+    prev_lat, prev_lon = group['lat'].shift(1).values, group['lon'].shift(1).values
+    next_lat, next_lon = group['lat'].shift(-1).values, group['lon'].shift(-1).values
+    single = (group['id'].transform('size') == 1).values
+    features = pd.DataFrame(index=df.index)
+    features['dist_to_prev'] = _haversine(prev_lat, prev_lon, df['lat'].values, df['lon'].values)
+    features['dist_to_next'] = np.where(single, -1.0, _haversine(df['lat'].values, df['lon'].values, next_lat, next_lon))
+    features['dist_prev_to_next'] = np.where(single, -1.0, _haversine(prev_lat, prev_lon, next_lat, next_lon))
+    features['time_to_prev'] = group['datetime'].diff().dt.total_seconds().values
+    features['speed_to_prev'] = features['dist_to_prev'] / features['time_to_prev']
+    return df, features
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_dist_features_match_reference(seed):
+    df = _frame(seed=seed)
+    expected, features = _reference_features(df)
+
+    result = df.copy()
+    trajutils.create_update_dist_features(result)
+    labels = ['dist_to_prev', 'dist_to_next', 'dist_prev_to_next']
+    pd.testing.assert_frame_equal(result, pd.concat([expected, features[labels]], axis=1), rtol=1e-9)
+
+    result = df.copy()
+    trajutils.create_update_dist_time_speed_features(result)
+    labels = ['dist_to_prev', 'time_to_prev', 'speed_to_prev']
+    pd.testing.assert_frame_equal(result, pd.concat([expected, features[labels]], axis=1), rtol=1e-9)
+
+
+def _jumps(features, jump_coefficient=1.5, threshold=1):
+    dist_prev_to_next = features['dist_prev_to_next']
+    return (features['dist_to_next'] > threshold) & (features['dist_to_prev'] > threshold) & (dist_prev_to_next > threshold) & \
+        (jump_coefficient * dist_prev_to_next < features['dist_to_next']) & (jump_coefficient * dist_prev_to_next < features['dist_to_prev'])
+
+
+def _speed_to_next(df, features):
+    group = df.groupby('id')
+    time_to_next = -group['datetime'].diff(-1).dt.total_seconds().values
+    return features['dist_to_next'].where(features['dist_to_next'] >= 0) / time_to_next
+
+
+CLEANING = [
+    (trajutils.clean_gps_jumps_by_distance, {'jump_coefficient': 1.5},
+     ['dist_to_prev', 'dist_to_next', 'dist_prev_to_next'], _jumps),
+    (trajutils.clean_gps_nearby_points_by_distances, {'radius_area': 80.0},
+     ['dist_to_prev', 'dist_to_next', 'dist_prev_to_next'], lambda features: features['dist_to_prev'] <= 80.0),
+    (trajutils.clean_gps_nearby_points_by_speed, {'speed_radius': 0.3},
+     ['dist_to_prev', 'time_to_prev', 'speed_to_prev'], lambda features: features['speed_to_prev'] <= 0.3),
+    (trajutils.clean_gps_speed_max_radius, {'speed_max': 3.0},
+     ['dist_to_prev', 'time_to_prev', 'speed_to_prev', 'speed_to_next'],
+     lambda features: (features['speed_to_prev'] > 3.0) | (features['speed_to_next'] > 3.0)),
+]
+
+
+@pytest.mark.parametrize('clean, kwargs, labels, filter_', CLEANING)
+def test_clean_gps_matches_full_recomputation(clean, kwargs, labels, filter_):
+    """ the incremental cleaning drops the same points as recomputing all features after each round """
+    df = _frame(seed=2)
+    expected = df
+    drop_by_round = []
+    while True:
+        expected, features = _reference_features(expected)
+        features['speed_to_next'] = _speed_to_next(expected, features)
+        drop = filter_(features).values
+        if not drop.any():
+            break
+        drop_by_round.append(np.count_nonzero(drop))
+        expected = expected.loc[~drop]
+
+    result = df.copy()
+    assert clean(result, **kwargs) == drop_by_round
+    assert len(drop_by_round) > 0
+    expected = pd.concat([expected, features[labels]], axis=1)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True)[expected.columns], expected, rtol=1e-9)
+
+
+def _stop_frame(n_segments=80, seed=3):
+    """ shuffled segments of 1 to 8 points, each with a single most repeated position """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for segment in rng.permutation(n_segments):
+        size = int(rng.integers(1, 9))
+        lat = -3.8 + rng.normal(0, 0.01, size)
+        lon = -38.5 + rng.normal(0, 0.01, size)
+        mode = rng.permutation(size)[:size // 2 + 1]
+        lat[mode], lon[mode] = lat[mode[0]], lon[mode[0]]
+        frames.append(pd.DataFrame({'id': 'M{:03d}'.format(segment % 7), 'lat': lat, 'lon': lon,
+                                    'segment_stop': segment, 'stop': bool(rng.random() < 0.6)}))
+    return pd.concat(frames).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def _reference_compress(df, point_mean, drop_moves):
+    """ per segment, as the loop replaced: the first and last points of stop segments get its point, other points are dropped """
+    df = df.copy()
+    df['lat_mean'] = -1.0
+    df['lon_mean'] = -1.0
+    if not drop_moves:
+        df.loc[~df['stop'], ['lat_mean', 'lon_mean']] = np.nan
+    for segment in df.loc[df['stop'], 'segment_stop'].unique():
+        rows = df.index[df['segment_stop'] == segment]
+        if rows.shape[0] > 1:
+            points = df.loc[rows]
+            if point_mean == 'default':
+                lat, lon = points.groupby(['lat', 'lon']).size().idxmax()
+            else:
+                lat, lon = points['lat'].mean(), points['lon'].mean()
+            df.loc[[rows[0], rows[-1]], 'lat_mean'] = lat
+            df.loc[[rows[0], rows[-1]], 'lon_mean'] = lon
+    return df.loc[~((df['lat_mean'] == -1.0) & (df['lon_mean'] == -1.0))]
+
+
+@pytest.mark.parametrize('point_mean', ['default', 'centroid'])
+@pytest.mark.parametrize('drop_moves', [True, False])
+def test_compress_segment_stop_matches_reference(point_mean, drop_moves):
+    df = _stop_frame()
+    result = df.copy()
+    trajutils.compress_segment_stop_to_point(result, point_mean=point_mean, drop_moves=drop_moves)
+    expected = _reference_compress(df, point_mean, drop_moves)
+    assert expected['stop'].any() and (~expected['stop']).any() == (not drop_moves)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def _reference_segments(df, thresholds):
+    """ as the per-id loops replaced: ids in order of first appearance, points in frame order, a new segment after each break """
+    segments = np.zeros(df.shape[0], dtype=np.int64)
+    curr_segment = 0
+    for id_ in pd.unique(df['id']):
+        rows = np.flatnonzero(df['id'].values == id_)
+        curr_segment += 1
+        for row in rows if rows.shape[0] > 1 else []:
+            if any(df[label].values[row] > max_value for label, max_value in thresholds.items()):
+                curr_segment += 1
+            segments[row] = curr_segment
+        if rows.shape[0] == 1:
+            segments[rows] = curr_segment
+    return segments
+
+
+SEGMENTATION = [
+    (trajutils.segment_traj_by_max_dist, {'max_dist_between_adj_points': 1000}, {'dist_to_prev': 1000}, 'tid_dist'),
+    (trajutils.segment_traj_by_max_time, {'max_time_between_adj_points': 120}, {'time_to_prev': 120}, 'tid_time'),
+    (trajutils.segment_traj_by_max_time, {'max_time_between_adj_points': 120, 'label_segment': 'id'}, {'time_to_prev': 120}, 'id'),
+    (trajutils.segment_traj_by_max_speed, {'max_speed_between_adj_points': 15}, {'speed_to_prev': 15}, 'tid_speed'),
+    (trajutils.segment_traj_by_dist_time_speed,
+     {'max_dist_between_adj_points': 1000, 'max_time_between_adj_points': 120, 'max_speed_between_adj_points': 15},
+     {'dist_to_prev': 1000, 'time_to_prev': 120, 'speed_to_prev': 15}, 'tid_part'),
+]
+
+
+@pytest.mark.parametrize('segment, kwargs, thresholds, label_segment', SEGMENTATION)
+def test_segment_traj_matches_per_id_loop(segment, kwargs, thresholds, label_segment):
+    """ on shuffled points, with the points of each id spread over the frame and single point ids """
+    rng = np.random.default_rng(4)
+    size = 2000
+    df = pd.DataFrame({'id': rng.integers(0, 150, size),
+                       'dist_to_prev': rng.exponential(500, size),
+                       'time_to_prev': rng.exponential(60, size),
+                       'speed_to_prev': rng.exponential(10, size)})
+    df = pd.concat([df, pd.DataFrame({'id': [1000, 1001], 'dist_to_prev': 5000.0, 'time_to_prev': 500.0, 'speed_to_prev': 50.0})],
+                   ignore_index=True)
+
+    result = df.copy()
+    segment(result, **kwargs)
+    expected = df.copy()
+    expected[label_segment] = _reference_segments(df, thresholds)
+    if label_segment != 'id':
+        expected.insert(0, 'id', expected.pop('id'))
+    else:
+        expected.insert(expected.shape[1] - 1, 'id', expected.pop('id'))
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize('create', [trajutils.create_update_dist_features, trajutils.create_update_dist_time_speed_features])
+def test_parallel_features_match_serial(create):
+    """ with n_jobs the features and row order are those of the serial run """
+    df = _frame(seed=5)
+    df['kind'] = pd.Categorical(np.where(df.index % 3 == 0, 'bus', 'car'))
+    expected = df.copy()
+    create(expected)
+    result = df.copy()
+    create(result, n_jobs=2)
+    pd.testing.assert_frame_equal(result, expected, rtol=1e-12)
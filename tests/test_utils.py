@@ -0,0 +1,24 @@
+import logging
+import sys
+import time
+from pymove import utils as ut
+
+
+def test_log_progress_without_size(caplog, monkeypatch):
+    """ outside notebooks, without ipywidgets """
+    monkeypatch.setitem(sys.modules, 'ipywidgets', None)
+    items = (i for i in range(5))
+    with caplog.at_level(logging.INFO, logger='pymove'):
+        assert list(ut.log_progress(items, name='Points')) == [0, 1, 2, 3, 4]
+    assert caplog.messages[-1].startswith('Points: 5 in ')
+
+
+def test_progress_update_rate_limit_per_reporter(caplog):
+    start_a = time.time()
+    start_b = start_a + 1
+    with caplog.at_level(logging.INFO, logger='pymove'):
+        assert ut.progress_update(1, 10, start_a, -1)[1] is not None
+        assert ut.progress_update(1, 10, start_b, -1)[1] is not None
+        assert ut.progress_update(2, 10, start_a, 10)[1] is None
+        assert ut.progress_update(10, 10, start_a, 20)[1] is not None
+    assert len(caplog.messages) == 3